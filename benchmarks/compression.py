@@ -0,0 +1,83 @@
+"""Measures the size of the database and the read latency of the XML export of stored quizzes, with the export
+stored as plain XML and compressed with zlib.
+
+Usage: python benchmarks/compression.py [--quizzes 10000] [--questions 30]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sqlalchemy
+
+import config
+from database import Database, Quiz
+from wrapper import Wrapper
+
+WORDS = ["what", "is", "the", "value", "of", "term", "energy", "cell", "process", "function", "which", "defines"]
+
+
+def get_quiz_xml(rnd: random.Random, question_number: int) -> str:
+    rows = []
+    for i in range(question_number):
+        options = [" ".join(rnd.choices(WORDS, k=4)) for _ in range(4)]
+        rows.append({
+            "type": rnd.choice(["Single Correct", "Multiple Correct"]),
+            "text": f"Question {i}: " + " ".join(rnd.choices(WORDS, k=20)),
+            "options": options,
+            "answers": rnd.sample(options, 2)
+        })
+    return Wrapper.rows_to_xml(rows=rows)
+
+
+def measure_reads(database: Database, keys: list[str], read_number: int) -> list[float]:
+    """Sorted latencies of reading the XML export of random quizzes, in seconds."""
+    rnd = random.Random(1)
+    latencies = []
+    for _ in range(read_number):
+        key = rnd.choice(keys)
+        start = time.perf_counter()
+        database.get_quiz_xml(key=key)
+        latencies.append(time.perf_counter() - start)
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quizzes", type=int, default=10000)
+    parser.add_argument("--questions", type=int, default=30)
+    parser.add_argument("--reads", type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f"{args.quizzes} quizzes of {args.questions} questions, {args.reads} reads")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, compression_enabled in (("plain XML", False), ("zlib", True)):
+            # The format is chosen when a quiz is stored
+            config.QUIZ_COMPRESSION_ENABLED = compression_enabled
+            path = os.path.join(directory, f"{name.replace(' ', '_')}.db")
+            database = Database(path=path)
+
+            rnd = random.Random(0)
+            keys = [
+                database.add_new_quiz(name="benchmark", quiz_xml=get_quiz_xml(rnd=rnd, question_number=args.questions))
+                for _ in range(args.quizzes)
+            ]
+            with database.engine.connect() as connection:
+                connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+                export_size = connection.execute(sqlalchemy.func.sum(sqlalchemy.func.length(Quiz.quiz_xml))).scalar()
+
+            latencies = measure_reads(database=database, keys=keys, read_number=args.reads)
+            mean = sum(latencies) / len(latencies)
+            p99 = latencies[int(len(latencies) * 0.99)]
+            print(f"{name}: database {os.path.getsize(path) / 2 ** 20:.1f} MiB "
+                  f"(XML exports {export_size / 2 ** 20:.1f} MiB), "
+                  f"read {mean * 1e6:.0f} us on average, p99 {p99 * 1e6:.0f} us")
+            database.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Measures read throughput of the quiz page queries while other threads store quizzes, with the configured
+`DATABASE_PRAGMAS` (WAL) and with the default rollback journal of SQLite.
+
+Usage: python benchmarks/concurrency.py [--readers 8] [--writers 2] [--duration 5]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config
+from database import Database
+from wrapper import Wrapper
+
+ROLLBACK_JOURNAL_PRAGMAS = {"journal_mode": "DELETE", "synchronous": "FULL", "busy_timeout": 5000}
+
+
+def get_quiz_xml(question_number: int) -> str:
+    rows = [
+        {"type": "Single Correct", "text": f"Question {i}", "options": ["a", "b", "c", "d"], "answers": ["b"]}
+        for i in range(question_number)
+    ]
+    return Wrapper.rows_to_xml(rows=rows)
+
+
+def run(database: Database, keys: list[str], quiz_xml: str, reader_number: int, writer_number: int,
+        duration: float) -> dict[str, list]:
+    """Read latencies (in seconds), failed reads and stored quizzes of every thread, until `duration` is over."""
+    results = {"latencies": [], "failed_reads": [], "writes": []}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def read(seed: int):
+        rnd = random.Random(seed)
+        latencies, failed = [], 0
+        while not stop.is_set():
+            key = rnd.choice(keys)
+            start = time.perf_counter()
+            try:
+                quiz = database.get_quiz_by_key(key=key)
+                database.get_question(key=key, position=rnd.randrange(quiz["question_number"]))
+            except Exception:
+                failed += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+        with lock:
+            results["latencies"].extend(latencies)
+            results["failed_reads"].append(failed)
+
+    def write():
+        written = 0
+        while not stop.is_set():
+            database.add_new_quiz(name="benchmark", quiz_xml=quiz_xml)
+            written += 1
+        with lock:
+            results["writes"].append(written)
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(reader_number)]
+    threads += [threading.Thread(target=write) for _ in range(writer_number)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--quizzes", type=int, default=1000)
+    parser.add_argument("--questions", type=int, default=30)
+    args = parser.parse_args()
+
+    quiz_xml = get_quiz_xml(question_number=args.questions)
+    print(f"{args.readers} readers, {args.writers} writers, {args.duration:.0f} s, "
+          f"{args.quizzes} stored quizzes of {args.questions} questions")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, pragmas in (("rollback journal", ROLLBACK_JOURNAL_PRAGMAS), ("configured", config.DATABASE_PRAGMAS)):
+            # Pragmas are set on the connections of the engine, which is created for each path once
+            config.DATABASE_PRAGMAS = pragmas
+            database = Database(path=os.path.join(directory, f"{name.replace(' ', '_')}.db"))
+            keys = [database.add_new_quiz(name="benchmark", quiz_xml=quiz_xml) for _ in range(args.quizzes)]
+
+            results = run(database=database, keys=keys, quiz_xml=quiz_xml, reader_number=args.readers,
+                          writer_number=args.writers, duration=args.duration)
+            latencies = sorted(results["latencies"])
+            p50 = latencies[len(latencies) // 2] if latencies else 0
+            p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+            print(f"{name}: {len(latencies) / args.duration:.0f} reads/s (p50 {p50 * 1000:.2f} ms, "
+                  f"p99 {p99 * 1000:.2f} ms, {sum(results['failed_reads'])} failed), "
+                  f"{sum(results['writes']) / args.duration:.0f} writes/s")
+            database.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
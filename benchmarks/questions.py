@@ -0,0 +1,98 @@
+"""Measures memory and access time of a loaded quiz, with questions compiled into records by `Wrapper` and with
+questions read from the parsed XML on every access.
+
+Usage: python benchmarks/questions.py [--questions 100] [--accesses 100000]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from wrapper import Wrapper
+
+CHOICES = ("True", "false", "Option 1", "42", "42.00001", "an answer")
+
+
+def get_quiz_xml(question_number: int, seed: int = 0) -> str:
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(question_number):
+        question_type = rnd.choice(["True/False", "Single Correct", "Multiple Correct", "No Choice", "Math Problem"])
+        text = f"Question {i}: " + " ".join(rnd.choice(["what", "is", "the", "value", "of", "term"]) for _ in range(20))
+        options = None
+        if question_type == "True/False":
+            answers = [rnd.choice(["True", "False"])]
+        elif question_type == "Single Correct":
+            options = [f"Option {j}" for j in range(4)]
+            answers = [rnd.choice(options)]
+        elif question_type == "Multiple Correct":
+            options = [f"Option {j}" for j in range(5)]
+            answers = rnd.sample(options, 2)
+        elif question_type == "Math Problem":
+            answers = [str(rnd.randint(1, 100))]
+        else:
+            answers = ["An answer"]
+        rows.append({"type": question_type, "text": text, "options": options, "answers": answers})
+    return Wrapper.rows_to_xml(rows=rows)
+
+
+def measure_memory(load) -> tuple[object, int]:
+    """Loaded object and the memory it keeps, in bytes."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    loaded = load()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return loaded, size
+
+
+def measure_accesses(access, question_number: int, access_number: int) -> float:
+    """Time of one access (a question read and one of its answers checked), in nanoseconds."""
+    rnd = random.Random(1)
+    positions = [rnd.randrange(question_number) for _ in range(access_number)]
+    choices = [rnd.choice(CHOICES) for _ in range(access_number)]
+    start = time.perf_counter()
+    for position, choice in zip(positions, choices):
+        access(position, choice)
+    return (time.perf_counter() - start) / access_number * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--questions", type=int, default=100)
+    parser.add_argument("--accesses", type=int, default=100000)
+    args = parser.parse_args()
+
+    quiz_xml = get_quiz_xml(question_number=args.questions)
+
+    # Questions are built from the XML element whenever they are shown
+    tree, tree_size = measure_memory(lambda: Wrapper.str_to_xml(data=quiz_xml))
+
+    def access_tree(position: int, choice: str) -> bool:
+        element = tree.findall("question")[position]
+        question = Wrapper.get_question(row=Wrapper.get_question_row(element=element))
+        return question.is_correct(choice)
+
+    wrapper, records_size = measure_memory(lambda: Wrapper(xml_str=quiz_xml, seed=0))
+    start = time.perf_counter()
+    Wrapper(xml_str=quiz_xml, seed=0)
+    load_time = time.perf_counter() - start
+
+    def access_records(position: int, choice: str) -> bool:
+        return wrapper[position].is_correct(choice)
+
+    tree_time = measure_accesses(access_tree, question_number=args.questions, access_number=args.accesses)
+    records_time = measure_accesses(access_records, question_number=args.questions, access_number=args.accesses)
+
+    print(f"{args.questions} questions, {len(quiz_xml)} characters of XML, {args.accesses} accesses")
+    print(f"parsed XML: {tree_size / 1024:.0f} KiB, {tree_time:.0f} ns per access")
+    print(f"records:    {records_size / 1024:.0f} KiB, {records_time:.0f} ns per access "
+          f"(compiled once in {load_time * 1000:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,259 @@
+import math
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator
+
+import sqlalchemy
 import streamlit as st
 from langchain_anthropic.chat_models import ChatAnthropic
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, BaseMessageChunk, SystemMessage
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
 
 import config
+from scheduler import Scheduler
 
+CacheBase = declarative_base()
 
-class Chain:
-    def __init__(self):
-        self.llm = ChatAnthropic(
-            api_key=st.secrets["ANTHROPIC_API_KEY"],
-            model=config.ANTHROPIC_MODEL_NAME
+
+class CachedResponse(CacheBase):
+    __tablename__ = "response"
+
+    key = sqlalchemy.Column(sqlalchemy.TEXT, primary_key=True)
+    response = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=False)
+    size = sqlalchemy.Column(sqlalchemy.Integer, unique=False, nullable=False)
+    created_at = sqlalchemy.Column(sqlalchemy.Float, unique=False, nullable=False, index=True)
+    accessed_at = sqlalchemy.Column(sqlalchemy.Float, unique=False, nullable=False, index=True)
+
+
+class ResponseCache:
+    def __init__(self, path: str, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+
+        CacheBase.metadata.create_all(self.engine)
+
+        self.Session = sessionmaker(bind=self.engine)
+
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @contextmanager
+    def session_scope(self):
+        session = self.Session()
+        try:
+            yield session
+            session.commit()  # Commit if no errors
+        except Exception as e:
+            session.rollback()  # Rollback in case of error
+            raise e
+        finally:
+            session.close()  # Always close the session
+
+    @staticmethod
+    def get_key(model: str, messages: list[BaseMessage]) -> str:
+        """Content address of the rendered prompt."""
+        key = hashlib.sha256(model.encode("utf-8"))
+        for message in messages:
+            key.update(b"\0" + message.type.encode("utf-8") + b"\0" + str(message.content).encode("utf-8"))
+        return key.hexdigest()
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self.session_scope() as session:
+            entry = session.get(CachedResponse, key)
+            if entry is None or entry.created_at + self.ttl < now:
+                self._count("misses")
+                return None
+
+            entry.accessed_at = now
+            self._count("hits")
+            return entry.response
+
+    def put(self, key: str, response: str):
+        now = time.time()
+        with self.session_scope() as session:
+            session.merge(CachedResponse(
+                key=key, response=response, size=len(response.encode("utf-8")), created_at=now, accessed_at=now
+            ))
+            session.flush()
+
+            # Expired entries go first, then the least recently used ones until the cache fits into `max_size`
+            evicted = session.query(CachedResponse).filter(CachedResponse.created_at + self.ttl < now).delete()
+
+            total_size = session.query(sqlalchemy.func.sum(CachedResponse.size)).scalar() or 0
+            if total_size > self.max_size:
+                query = session.query(CachedResponse.key, CachedResponse.size).order_by(CachedResponse.accessed_at)
+                for entry_key, entry_size in query.all():
+                    if total_size <= self.max_size:
+                        break
+                    session.query(CachedResponse).filter_by(key=entry_key).delete()
+                    total_size -= entry_size
+                    evicted += 1
+
+        self._count("evictions", evicted)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+        requests = counters["hits"] + counters["misses"]
+        counters["hit_rate"] = counters["hits"] / requests if requests else 0.0
+        return counters
+
+
+@dataclass
+class LLMUsage:
+    input_tokens: int = 0
+    output_tokens: int = 0
+    # Parts of `input_tokens` which were read from or written to the prompt cache of the provider
+    cache_read_input_tokens: int = 0
+    cache_creation_input_tokens: int = 0
+
+    @classmethod
+    def from_message(cls, message: AIMessage) -> "LLMUsage":
+        usage_metadata = message.usage_metadata or {}
+        input_token_details = usage_metadata.get("input_token_details", {})
+        return cls(
+            input_tokens=usage_metadata.get("input_tokens", 0),
+            output_tokens=usage_metadata.get("output_tokens", 0),
+            cache_read_input_tokens=input_token_details.get("cache_read", 0),
+            cache_creation_input_tokens=input_token_details.get("cache_creation", 0)
         )
 
-        question_generation_template = ChatPromptTemplate([
+    def add(self, other: "LLMUsage"):
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.cache_read_input_tokens += other.cache_read_input_tokens
+        self.cache_creation_input_tokens += other.cache_creation_input_tokens
+
+
+@dataclass
+class ChainResponse:
+    text: str
+    usage: LLMUsage
+    # Whether the response was taken from `ResponseCache` without calling LLM
+    cached: bool = False
+
+
+class Chain:
+    DEFAULT_CLIENT_ID = "default"
+    # Default scheduler of chains, the one shared by the process (if it is enabled), `None` disables scheduling
+    SHARED_SCHEDULER = object()
+
+    def __init__(self, cache: ResponseCache | None = None, llm: BaseChatModel | None = None,
+                 scheduler: Scheduler | None | object = SHARED_SCHEDULER):
+        if scheduler is self.SHARED_SCHEDULER:
+            scheduler = Scheduler.get_shared() if config.LLM_SCHEDULER_ENABLED else None
+        self.scheduler = scheduler
+
+        if llm is None:
+            llm = ChatAnthropic(
+                api_key=st.secrets["ANTHROPIC_API_KEY"],
+                model=config.ANTHROPIC_MODEL_NAME,
+                max_tokens=config.LLM_MAX_OUTPUT_TOKENS,
+                default_headers=(
+                    {"anthropic-beta": "prompt-caching-2024-07-31"} if config.LLM_PROMPT_CACHING_ENABLED else None
+                ),
+                # Failed calls are retried by the scheduler, which also holds back calls of other sessions
+                **({"max_retries": 0} if scheduler is not None else {})
+            )
+        self.llm = llm
+
+        if cache is None and config.LLM_CACHE_ENABLED:
+            cache = ResponseCache(
+                path=config.LLM_CACHE_PATH,
+                max_size=config.LLM_CACHE_MAX_SIZE,
+                ttl=config.LLM_CACHE_TTL
+            )
+        self.cache = cache
+
+        self._question_generation_template = ChatPromptTemplate([
+            self.get_static_prefix(config.QUESTION_GENERATION_INSTRUCTIONS),
             ("user", config.QUESTION_GENERATION_PROMPT)
         ])
 
-        math_solver_template = ChatPromptTemplate([
-            ("user", config.MATH_SOLVER_EXAMPLE),
+        self._math_solver_template = ChatPromptTemplate([
+            self.get_static_prefix(config.MATH_SOLVER_INSTRUCTIONS, config.MATH_SOLVER_EXAMPLE),
             ("user", config.MATH_SOLVER_PROMPT)
         ])
 
-        self._question_generation_chain = (question_generation_template | self.llm | StrOutputParser())
-        self._math_solver_chain = (math_solver_template | self.llm | StrOutputParser())
+        # Timeout of a streamed request applies to every read, the whole request is limited by the generator
+        self._question_generation_chain = self.llm.bind(timeout=config.GENERATION_REQUEST_TIMEOUT)
+        self._math_solver_chain = self.llm.bind(timeout=config.MATH_SOLVER_TIMEOUT)
+
+    @staticmethod
+    def get_static_prefix(*texts: str) -> SystemMessage:
+        """System message with the invariant part of a prompt, which is marked to be cached by the provider."""
+        content = [{"type": "text", "text": text} for text in texts]
+        if config.LLM_PROMPT_CACHING_ENABLED:
+            # Everything up to and including the marked block is cached
+            content[-1]["cache_control"] = {"type": "ephemeral"}
+        return SystemMessage(content=content)
+
+    @staticmethod
+    def get_message_text(message: BaseMessage) -> str:
+        if isinstance(message.content, str):
+            return message.content
+        return "".join(block["text"] if isinstance(block, dict) else block for block in message.content)
+
+    def estimate_message_tokens(self, messages: list[BaseMessage]) -> int:
+        return sum(self.estimate_tokens(text=self.get_message_text(message=message)) for message in messages)
+
+    def _invoke(self, chain: Runnable, template: ChatPromptTemplate, inputs: dict[str, Any],
+                use_cache: bool, client_id: str | None = None) -> ChainResponse:
+        messages = template.format_messages(**inputs)
+        if use_cache and self.cache is not None:
+            key = self.cache.get_key(model=config.ANTHROPIC_MODEL_NAME, messages=messages)
+            text = self.cache.get(key=key)
+            if text is not None:
+                return ChainResponse(text=text, usage=LLMUsage(), cached=True)
+
+        if self.scheduler is None:
+            message = chain.invoke(messages)
+        else:
+            estimated_tokens = self.estimate_message_tokens(messages=messages)
+            try:
+                message = self.scheduler.call(
+                    client_id=client_id or self.DEFAULT_CLIENT_ID,
+                    tokens=estimated_tokens,
+                    function=lambda: chain.invoke(messages)
+                )
+            except Exception:
+                self.scheduler.settle(estimated_tokens=estimated_tokens, used_tokens=0)
+                raise
+        response = ChainResponse(text=StrOutputParser().invoke(message), usage=LLMUsage.from_message(message))
+        if self.scheduler is not None:
+            self.scheduler.settle(
+                estimated_tokens=estimated_tokens,
+                used_tokens=response.usage.input_tokens + response.usage.output_tokens
+            )
 
-    def question_generation(self, document: str, question_number_per_type: dict[str, int], difficulty: str,
-                            question_types: list[str], single_option_number: int, multiple_option_number: int) -> str:
-        return self._question_generation_chain.invoke({
+        if use_cache and self.cache is not None:
+            self.cache.put(key=key, response=response.text)
+        return response
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        return math.ceil(len(text) / config.CHARACTERS_PER_TOKEN)
+
+    @staticmethod
+    def _get_question_generation_inputs(document: str, question_number_per_type: dict, difficulty: str,
+                                        question_types: list[str], single_option_number: int,
+                                        multiple_option_number: int) -> dict[str, Any]:
+        return {
             "document": document,
             "allowed_question_types": config.ALLOWED_QUESTION_TYPES,
             "allowed_difficulty_levels": config.ALLOWED_DIFFICULTY_LEVELS,
@@ -36,9 +262,102 @@ class Chain:
             "single_option_number": single_option_number,
             "multiple_option_number": multiple_option_number,
             "question_number_per_type": question_number_per_type
-        })
+        }
+
+    def estimate_question_generation_overhead(self, difficulty: str, question_types: list[str],
+                                              single_option_number: int, multiple_option_number: int) -> int:
+        """Estimated number of prompt tokens of a question generation request besides the document itself."""
+        messages = self._question_generation_template.format_messages(**self._get_question_generation_inputs(
+            document="",
+            question_number_per_type={},
+            difficulty=difficulty,
+            question_types=question_types,
+            single_option_number=single_option_number,
+            multiple_option_number=multiple_option_number
+        ))
+        return self.estimate_message_tokens(messages=messages)
+
+    def question_generation(self, document: str, question_number_per_type: dict, difficulty: str,
+                            question_types: list[str], single_option_number: int, multiple_option_number: int,
+                            use_cache: bool = True, client_id: str | None = None) -> ChainResponse:
+        """`document` is either plain text or several `<section id="...">` elements, in the latter case
+        `question_number_per_type` is given per section id.
+
+        Calls with the same `client_id` (e.g. of one quiz) wait for their turn together in the scheduler."""
+        return self._invoke(chain=self._question_generation_chain, template=self._question_generation_template,
+                            use_cache=use_cache, client_id=client_id, inputs=self._get_question_generation_inputs(
+                                document=document,
+                                question_number_per_type=question_number_per_type,
+                                difficulty=difficulty,
+                                question_types=question_types,
+                                single_option_number=single_option_number,
+                                multiple_option_number=multiple_option_number
+                            ))
+
+    def stream_question_generation(self, document: str, question_number_per_type: dict, difficulty: str,
+                                   question_types: list[str], single_option_number: int, multiple_option_number: int,
+                                   usage: LLMUsage | None = None, use_cache: bool = True,
+                                   client_id: str | None = None,
+                                   on_start: Callable[[], None] | None = None) -> Iterator[str]:
+        """Same as `question_generation`, but yields the response piece by piece while LLM generates it.
+
+        Usage of the call is added to `usage`. The response is cached only if it was consumed completely.
+        `on_start()` is called whenever the call is sent to LLM (after it was let through by the scheduler).
+        """
+        messages = self._question_generation_template.format_messages(**self._get_question_generation_inputs(
+            document=document,
+            question_number_per_type=question_number_per_type,
+            difficulty=difficulty,
+            question_types=question_types,
+            single_option_number=single_option_number,
+            multiple_option_number=multiple_option_number
+        ))
+        usage = usage if usage is not None else LLMUsage()
+
+        if use_cache and self.cache is not None:
+            key = self.cache.get_key(model=config.ANTHROPIC_MODEL_NAME, messages=messages)
+            text = self.cache.get(key=key)
+            if text is not None:
+                yield text
+                return
+
+        def start_stream() -> Iterator[BaseMessageChunk]:
+            if on_start is not None:
+                on_start()
+            return self._question_generation_chain.stream(messages)
+
+        if self.scheduler is None:
+            message_chunks = start_stream()
+        else:
+            estimated_tokens = self.estimate_message_tokens(messages=messages)
+            message_chunks = self.scheduler.stream(
+                client_id=client_id or self.DEFAULT_CLIENT_ID,
+                tokens=estimated_tokens,
+                function=start_stream
+            )
+
+        pieces = []
+        call_usage = LLMUsage()
+        try:
+            for message_chunk in message_chunks:
+                call_usage.add(LLMUsage.from_message(message_chunk))
+                piece = self.get_message_text(message=message_chunk)
+                if piece:
+                    pieces.append(piece)
+                    yield piece
+        finally:
+            usage.add(call_usage)
+            if self.scheduler is not None:
+                self.scheduler.settle(
+                    estimated_tokens=estimated_tokens,
+                    used_tokens=call_usage.input_tokens + call_usage.output_tokens
+                )
+
+        if use_cache and self.cache is not None:
+            self.cache.put(key=key, response="".join(pieces))
 
-    def math_solver(self, math_problem: str) -> str:
-        return self._math_solver_chain.invoke({
-            "math_problem": math_problem
-        })
+    def math_solver(self, math_problem: str, use_cache: bool = True, client_id: str | None = None) -> ChainResponse:
+        return self._invoke(chain=self._math_solver_chain, template=self._math_solver_template,
+                            use_cache=use_cache, client_id=client_id, inputs={
+                                "math_problem": math_problem
+                            })
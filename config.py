@@ -1,4 +1,15 @@
+import os
+
 DATABASE_PATH = "database.db"
+# Set on every connection to the database. In WAL mode readers are not blocked by a writer, and `synchronous=NORMAL`
+# loses only the last transactions on a power failure (never corrupts the database)
+DATABASE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,  # in milliseconds
+    "cache_size": -64 * 1024,  # in KiB
+    "mmap_size": 256 * 1024 * 1024  # in bytes
+}
 
 ALLOWED_FILE_TYPES = ["txt", "pdf", "docx"]
 ALLOWED_DIFFICULTY_LEVELS = ["Easy", "Medium", "Hard"]
@@ -10,51 +21,141 @@ DIFFICULTY_QUESTION_TYPE_DISTRIBUTION = {
 }
 
 ANTHROPIC_MODEL_NAME = "claude-3-haiku-20240307"
+LLM_MAX_OUTPUT_TOKENS = 4096
+# Static instructions of prompts are cached by Anthropic (only prefixes longer than 1024 tokens, 2048 for Haiku models)
+LLM_PROMPT_CACHING_ENABLED = True
+
+# Calls to LLM from all sessions of the server process share requests and tokens (prompt and output) per minute
+# budgets, 0 disables a budget. Waiting calls of different quizzes take turns, throttled calls (429 and 529) and
+# other transient failures (connection errors, 408, 409 and 5xx) are retried up to `LLM_MAX_RETRIES` times after
+# `retry-after` or an exponential backoff with jitter (in seconds)
+LLM_SCHEDULER_ENABLED = True
+LLM_REQUESTS_PER_MINUTE = 50
+LLM_TOKENS_PER_MINUTE = 100000
+LLM_MAX_RETRIES = 5
+LLM_RETRY_BASE_DELAY = 1
+LLM_RETRY_MAX_DELAY = 60
+
+# Responses of LLM are cached by rendered prompt, set `LLM_CACHE_ENABLED` to `False` to always call the model
+LLM_CACHE_ENABLED = True
+LLM_CACHE_PATH = os.path.join(os.path.dirname(DATABASE_PATH), "llm_cache.db")
+LLM_CACHE_MAX_SIZE = 256 * 1024 * 1024  # in bytes
+LLM_CACHE_TTL = 30 * 24 * 60 * 60  # in seconds
 
 TEXT_CHUNK_SIZE = 4096
 TEXT_CHUNK_OVERLAP = 256
-
-
-QUESTION_GENERATION_PROMPT = """
+# Text is split on the first of them which occurs in it, parts longer than a chunk on the next ones
+TEXT_CHUNK_SEPARATORS = ["\n\n", "\n", " ", ""]
+
+# Pages of long PDF files are extracted in several processes, `PDF_PAGES_PER_TASK` pages at a time
+PDF_EXTRACTION_PROCESSES = os.cpu_count() or 1
+PDF_PARALLEL_MIN_PAGES = 64
+PDF_PAGES_PER_TASK = 16
+
+# Additional `(old, new)` replacements applied to extracted PDF text after the built-in ones, in the given order
+PDF_EXTRA_NORMALIZATION_RULES = []
+
+# Extracted text and text chunks of uploaded files are cached by content of the file
+READER_CACHE_ENABLED = True
+READER_CACHE_PATH = os.path.join(os.path.dirname(DATABASE_PATH), "reader_cache")
+READER_CACHE_MAX_SIZE = 512 * 1024 * 1024  # in bytes
+
+# Parsed quizzes are kept in memory of the server process for all sessions, up to `QUIZ_CACHE_MAX_SIZE` quizzes
+# which were opened most recently
+QUIZ_CACHE_MAX_SIZE = 256
+# XML export of quizzes is stored compressed with zlib (set `QUIZ_COMPRESSION_ENABLED` to `False` to store plain XML).
+# Stored quizzes keep their format, both formats are read
+QUIZ_COMPRESSION_ENABLED = True
+QUIZ_COMPRESSION_LEVEL = 6
+# Questions of quizzes stored only as XML by older versions are moved to the question table in the background at
+# start-up, `QUIZ_MIGRATION_BATCH_SIZE` quizzes per transaction with a pause of `QUIZ_MIGRATION_PAUSE` seconds between
+# them. A quiz which is opened before is migrated at once
+QUIZ_MIGRATION_BATCH_SIZE = 500
+QUIZ_MIGRATION_PAUSE = 0.1
+
+# Text chunks are compared by hashed word n-gram vectors to spread questions over the whole document,
+# chunks more similar than `CHUNK_DUPLICATE_SIMILARITY` (cosine) to an already used one are left as a fallback
+CHUNK_SIGNATURE_DIMENSION = 1024
+CHUNK_SIGNATURE_NGRAM_SIZE = 2
+CHUNK_DUPLICATE_SIMILARITY = 0.9
+
+# Generated questions are compared by MinHash signatures of word shingles of their text and options, a question
+# whose estimated Jaccard similarity to an accepted one reaches `QUESTION_DUPLICATE_SIMILARITY` is replaced.
+# Signatures are split into `MINHASH_BAND_NUMBER` bands, only questions sharing a band with it are compared
+QUESTION_DUPLICATE_SIMILARITY = 0.7
+QUESTION_SHINGLE_SIZE = 2
+MINHASH_PERMUTATION_NUMBER = 128
+MINHASH_BAND_NUMBER = 32
+
+# Several text chunks are packed into one question generation request (as sections with their own question quotas)
+# while its estimated prompt fits into `REQUEST_TOKEN_BUDGET` and its estimated output into `LLM_MAX_OUTPUT_TOKENS`,
+# (questions of a chunk which alone would not fit are split over several requests), set `REQUEST_TOKEN_BUDGET` to 0
+# to send every chunk in a separate request
+REQUEST_TOKEN_BUDGET = 16000
+CHARACTERS_PER_TOKEN = 4
+QUESTION_TOKEN_ESTIMATE = 200
+
+# Maximum number of requests sent to LLM at the same time
+GENERATION_MAX_CONCURRENCY = 4
+# If requests did not give enough valid questions, up to `GENERATION_MAX_FOLLOW_UP_REQUESTS` more are sent,
+# each asking only for the number of questions missing of every type
+GENERATION_MAX_FOLLOW_UP_REQUESTS = 2
+# Generation fails (and the job fails without a retry) if it gave fewer than `GENERATION_MIN_QUESTION_SHARE` of the
+# requested questions, and always if it gave none
+GENERATION_MIN_QUESTION_SHARE = 0.5
+# A request is cut off after `GENERATION_REQUEST_TIMEOUT` seconds (questions it gave so far are kept, the missing ones
+# are asked for by other requests). A request which gave no question after the `GENERATION_HEDGE_PERCENTILE`
+# of the time to the first question of the last `GENERATION_LATENCY_WINDOW` requests is sent once more, and the response
+# which starts first is used. Hedging starts after `GENERATION_HEDGE_MIN_SAMPLES` requests, set the percentile to 0
+# to disable it
+GENERATION_REQUEST_TIMEOUT = 180
+GENERATION_HEDGE_PERCENTILE = 95
+GENERATION_HEDGE_MIN_SAMPLES = 20
+GENERATION_LATENCY_WINDOW = 200
+# Maximum number of math problems solved at the same time and timeout (in seconds) for a single solver call
+MATH_SOLVER_MAX_CONCURRENCY = 8
+MATH_SOLVER_TIMEOUT = 60
+# Python code of math solver responses is run to get the answer, in separate processes (at most
+# `SANDBOX_MAX_PROCESSES` at a time) limited to `SANDBOX_TIMEOUT` seconds and `SANDBOX_MEMORY_LIMIT` bytes,
+# the answer written by the model is used only if the code is missing or fails or does not print a number on its
+# last line. Keep it disabled unless `SANDBOX_ISOLATION_COMMAND` cuts the process off from the network and the files
+# of the server, e.g. `("nsjail", "--config", "sandbox.cfg", "--")`, and `SANDBOX_USER` is a user without access
+# to them
+SANDBOX_ENABLED = False
+SANDBOX_ISOLATION_COMMAND = ()
+SANDBOX_USER = None
+SANDBOX_MAX_PROCESSES = os.cpu_count() or 1
+SANDBOX_TIMEOUT = 10
+SANDBOX_MEMORY_LIMIT = 512 * 1024 * 1024  # in bytes
+SANDBOX_MAX_OUTPUT_SIZE = 64 * 1024  # in bytes, the code is stopped when it prints more
+
+# Quizzes are generated by background workers, at most `JOB_MAX_CONCURRENCY` at a time in one server process,
+# pages poll the status of a job every `JOB_POLL_INTERVAL` seconds
+JOB_MAX_CONCURRENCY = 2
+JOB_POLL_INTERVAL = 2
+# Workers mark their running jobs as alive every `JOB_HEARTBEAT_INTERVAL` seconds, a running job which was not
+# marked for `JOB_LEASE_TIMEOUT` seconds belongs to a stopped process and is put back into the queue
+JOB_HEARTBEAT_INTERVAL = 10
+JOB_LEASE_TIMEOUT = 60
+# A failed job is retried up to `JOB_MAX_ATTEMPTS` times in total, `JOB_RETRY_DELAY * attempt` seconds apart,
+# every attempt resumes from checkpoints of the previous ones
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 5
+
+
+# Instructions are the same for every request, so they are sent first and marked for prompt caching by the provider,
+# the document and the parameters of generation follow them in `QUESTION_GENERATION_PROMPT`.
+# Instructions are not templates, so braces in them are not escaped
+QUESTION_GENERATION_INSTRUCTIONS = """
 You are an expert question generator tasked with creating a set of questions based on a given text document. 
 Your goal is to produce high-quality, varied questions that accurately reflect the content of the document 
 while adhering to specific requirements.
 
-First, carefully read the following document:
-
-<document>
-{document}
-</document>
-
-Now, you will generate questions based on this document. Here are the parameters for question generation:
-
-<allowed_question_types>
-{allowed_question_types}
-</allowed_question_types>
-
-<allowed_difficulty_levels>
-{allowed_difficulty_levels}
-</allowed_difficulty_levels>
-
-<difficulty>
-{difficulty}
-</difficulty>
-
-<question_types>
-{question_types}
-</question_types>
-
-<single_option_number>
-{single_option_number}
-</single_option_number>
+You will be given the document in a <document> element, followed by the parameters for question generation.
 
-<multiple_option_number>
-{multiple_option_number}
-</multiple_option_number>
-
-<question_number_per_type>
-{question_number_per_type}
-</question_number_per_type>
+The document may consist of several <section id="[section id]"> elements. In that case <question_number_per_type> 
+is given separately for each section id: base the questions for a section only on the text of this section and 
+put its id into a <section> element of each question.
 
 Instructions for each question type:
 
@@ -99,6 +200,7 @@ After completing the question creation process for each question, format your ou
 
 <questions>
   <question>
+    <section>[section id, only if the document consists of sections]</section>
     <type>[question type]</type>
     <text>[detailed question text]</text>
     <options>
@@ -126,7 +228,46 @@ Before finalizing your output, review all generated questions to ensure they:
 Remember to use strictly XML to structure your response without any additional text.
 """
 
+QUESTION_GENERATION_PROMPT = """
+First, carefully read the following document:
+
+<document>
+{document}
+</document>
+
+Now, you will generate questions based on this document. Here are the parameters for question generation:
+
+<allowed_question_types>
+{allowed_question_types}
+</allowed_question_types>
+
+<allowed_difficulty_levels>
+{allowed_difficulty_levels}
+</allowed_difficulty_levels>
+
+<difficulty>
+{difficulty}
+</difficulty>
+
+<question_types>
+{question_types}
+</question_types>
+
+<single_option_number>
+{single_option_number}
+</single_option_number>
+
+<multiple_option_number>
+{multiple_option_number}
+</multiple_option_number>
+
+<question_number_per_type>
+{question_number_per_type}
+</question_number_per_type>
+"""
+
 
+# Instructions and the example are sent before the math problem and marked for prompt caching, as for questions
 MATH_SOLVER_EXAMPLE = """
 <examples>
   <example>
@@ -160,12 +301,12 @@ MATH_SOLVER_EXAMPLE = """
         for i in range(1, 11):
             total += i
             
-        print(f\"The sum of numbers from 1 to 10 is: {{total}}\")
+        print(total)
         
         ```
         
         Code output:
-        The sum of numbers from 1 to 10 is: 55
+        55
       </thinking>
       <answer>55.0</answer>
     </ideal_output>
@@ -173,16 +314,11 @@ MATH_SOLVER_EXAMPLE = """
 </examples>
 """
 
-MATH_SOLVER_PROMPT = """
+MATH_SOLVER_INSTRUCTIONS = """
 You are an AI assistant specialized in solving mathematical problems. Your task is to solve the given 
 math problem using a combination of Chain of Thought (CoT) reasoning and Python code for calculations. 
 
-Here's the math problem you need to solve:
-
-<math_problem>
-{math_problem}
-</math_problem>
-
+You will be given the math problem in a <math_problem> element.
 
 Please follow these steps to solve the problem:
 
@@ -190,8 +326,9 @@ Please follow these steps to solve the problem:
 2. Determine the mathematical concepts involved.
 3. Plan the solution approach.
 4. Break down the solution into smaller steps.
-5. Write Python code to perform the necessary calculations.
-6. Execute the Python code and include the output.
+5. Write Python code to perform the necessary calculations. The code will be executed, so it must be 
+self-contained and print the final answer as a single number (without any text) on the last line of its output.
+6. Write down the output you expect the code to print.
 7. Provide the final answer to the problem as a float with no additional text.
 
 Format your output as follows:
@@ -215,7 +352,7 @@ Python code:
 ```
 
 Code output:
-[Include the actual output from executing the Python code]
+[The output you expect the Python code to print]
 
 </thinking>
 
@@ -224,8 +361,15 @@ Code output:
 </answer>
 
 Important notes:
-- Ensure that you actually execute the Python code and include its output in your response.
 - Your solution should demonstrate clear, logical reasoning throughout the process.
+"""
+
+MATH_SOLVER_PROMPT = """
+Here's the math problem you need to solve:
+
+<math_problem>
+{math_problem}
+</math_problem>
 
 Now, please solve the given math problem using this approach.
 """
@@ -1,12 +1,21 @@
+import json
+import time
 import uuid
+import zlib
+import logging
+import threading
 from contextlib import contextmanager
 from typing import Any
+from xml.etree import ElementTree
 
 import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 import config
+from wrapper import Wrapper
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
@@ -17,17 +26,199 @@ class Quiz(Base):
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
     key = sqlalchemy.Column(sqlalchemy.TEXT, unique=True, nullable=False)
     name = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=False)
-    quiz_xml = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=False)
+    # XML export of the quiz (read with `get_quiz_xml`), derived from its questions when they are stored (questions
+    # of quizzes stored before the question table existed are migrated from it). The app reads questions from the
+    # question table. Encoded as given by `quiz_format`, plain XML may also be stored as text by older versions
+    quiz_xml = sqlalchemy.Column(sqlalchemy.LargeBinary, unique=False, nullable=False)
+    quiz_format = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=False, server_default="xml")
+    # Whether the questions of the quiz are in the question table (quizzes stored by older versions are migrated)
+    questions_migrated = sqlalchemy.Column(sqlalchemy.Boolean, unique=False, nullable=False, server_default="0")
+
+
+class Question(Base):
+    __tablename__ = "question"
+    __table_args__ = (sqlalchemy.UniqueConstraint("quiz_id", "position"),)
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    quiz_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey("quiz.id"), unique=False, nullable=False)
+    # Order of the question in the generated quiz, starting from 0
+    position = sqlalchemy.Column(sqlalchemy.Integer, unique=False, nullable=False)
+    type = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=False, index=True)
+    text = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=True)
+    options = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=True)  # JSON list, NULL if the type has none
+    answers = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=False)  # JSON list
+
+
+class Job(Base):
+    __tablename__ = "job"
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    # Key of the quiz which is created once the job is done
+    key = sqlalchemy.Column(sqlalchemy.TEXT, unique=True, nullable=False)
+    name = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=False)
+    status = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=False, index=True)
+    # Uploaded file is kept only until the job is finished
+    file_name = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=False)
+    file_data = sqlalchemy.Column(sqlalchemy.LargeBinary, unique=False, nullable=True)
+    question_number = sqlalchemy.Column(sqlalchemy.Integer, unique=False, nullable=False)
+    difficulty = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=False)
+    question_types = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=False)  # JSON list
+    single_option_number = sqlalchemy.Column(sqlalchemy.Integer, unique=False, nullable=False)
+    multiple_option_number = sqlalchemy.Column(sqlalchemy.Integer, unique=False, nullable=False)
+    # Number of questions generated so far
+    progress = sqlalchemy.Column(sqlalchemy.Integer, unique=False, nullable=False, default=0)
+    error = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=True)
+    created_at = sqlalchemy.Column(sqlalchemy.Float, unique=False, nullable=False)
+    updated_at = sqlalchemy.Column(sqlalchemy.Float, unique=False, nullable=False)
+
+
+class Checkpoint(Base):
+    __tablename__ = "checkpoint"
+    __table_args__ = (sqlalchemy.UniqueConstraint("run_id", "key"),)
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    # Generation run the result belongs to (key of the job for quizzes generated by workers)
+    run_id = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=False, index=True)
+    # Hash of the LLM call which produced the result
+    key = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=False)
+    result = sqlalchemy.Column(sqlalchemy.TEXT, unique=False, nullable=False)
+    created_at = sqlalchemy.Column(sqlalchemy.Float, unique=False, nullable=False)
 
 
 class Database:
-    def __init__(self):
-        self.engine = sqlalchemy.create_engine(f"sqlite:///{config.DATABASE_PATH}")
+    JOB_QUEUED = "queued"
+    JOB_RUNNING = "running"
+    JOB_DONE = "done"
+    JOB_FAILED = "failed"
+
+    QUIZ_FORMAT_XML = "xml"
+    QUIZ_FORMAT_ZLIB = "xml+zlib"
 
-        Base.metadata.create_all(self.engine)
+    # Engines by database path, shared by all instances in the process, so the schema is created only once
+    _engines = dict()
+    _engines_lock = threading.Lock()
+
+    def __init__(self, path: str = config.DATABASE_PATH):
+        self.engine = self.get_engine(path=path)
 
         self.Session = sessionmaker(bind=self.engine)
 
+    @classmethod
+    def get_engine(cls, path: str) -> sqlalchemy.Engine:
+        with cls._engines_lock:
+            engine = cls._engines.get(path)
+            if engine is None:
+                engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+                sqlalchemy.event.listen(engine, "connect", cls._set_pragmas)
+                Base.metadata.create_all(engine)
+                cls._add_missing_columns(engine=engine)
+                cls._engines[path] = engine
+            return engine
+
+    @staticmethod
+    def _set_pragmas(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for key, value in config.DATABASE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {key} = {value}")
+        cursor.close()
+
+    @staticmethod
+    def _add_missing_columns(engine: sqlalchemy.Engine):
+        """Adds columns which were added to models after their tables were created, they must have a server default
+        or be nullable."""
+        inspector = sqlalchemy.inspect(engine)
+        with engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                existing = set(x["name"] for x in inspector.get_columns(table.name))
+                for column in table.columns:
+                    if column.name in existing:
+                        continue
+                    statement = f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                    statement += column.type.compile(dialect=engine.dialect)
+                    if not column.nullable:
+                        statement += " NOT NULL"
+                    if column.server_default is not None:
+                        statement += f" DEFAULT '{column.server_default.arg}'"
+                    connection.exec_driver_sql(statement)
+
+    @classmethod
+    def encode_quiz_xml(cls, quiz_xml: str) -> tuple[bytes, str]:
+        """Stored value of the XML export and its format."""
+        data = quiz_xml.encode("utf-8")
+        if config.QUIZ_COMPRESSION_ENABLED:
+            return zlib.compress(data, level=config.QUIZ_COMPRESSION_LEVEL), cls.QUIZ_FORMAT_ZLIB
+        return data, cls.QUIZ_FORMAT_XML
+
+    @classmethod
+    def decode_quiz_xml(cls, data: bytes | str, quiz_format: str) -> str:
+        if quiz_format == cls.QUIZ_FORMAT_ZLIB:
+            data = zlib.decompress(data)
+        elif quiz_format != cls.QUIZ_FORMAT_XML:
+            raise ValueError(f"Unknown quiz format '{quiz_format}'")
+        return data if isinstance(data, str) else data.decode("utf-8")
+
+    def migrate_quiz_questions(self, quiz_id: int | None = None) -> int:
+        """Stores questions of quizzes which were saved only as XML (of all of them or of the quiz with `quiz_id`) in
+        the question table, in small batches so that other writers are not blocked for long. Returns the number of
+        migrated quizzes."""
+        migrated = 0
+        while True:
+            with self.session_scope() as session:
+                query = session.query(Quiz).filter(Quiz.questions_migrated == sqlalchemy.false())
+                if quiz_id is not None:
+                    query = query.filter(Quiz.id == quiz_id)
+                quizzes = query.order_by(Quiz.id).limit(config.QUIZ_MIGRATION_BATCH_SIZE).all()
+                for quiz in quizzes:
+                    self._migrate_quiz(session=session, quiz=quiz)
+            migrated += len(quizzes)
+            if len(quizzes) < config.QUIZ_MIGRATION_BATCH_SIZE:
+                return migrated
+            time.sleep(config.QUIZ_MIGRATION_PAUSE)
+
+    def _migrate_quiz(self, session, quiz: Quiz):
+        """Quiz is marked as migrated even if none of its questions is valid, so it is not read again."""
+        # Quizzes stored since the question table exists already have their questions
+        has_questions = session.query(sqlalchemy.exists().where(Question.quiz_id == quiz.id)).scalar()
+        if not has_questions:
+            try:
+                quiz_xml = self.decode_quiz_xml(data=quiz.quiz_xml, quiz_format=quiz.quiz_format)
+                rows = self._get_legacy_rows(quiz_xml=quiz_xml)
+            except (ValueError, zlib.error, ElementTree.ParseError):
+                # Reading the quiz again would fail the same way, it keeps only its XML
+                logger.exception("Questions of quiz %d were not migrated", quiz.id)
+                rows = []
+            self._add_questions(session=session, quiz_id=quiz.id, rows=rows)
+        quiz.questions_migrated = True
+
+    @staticmethod
+    def _get_legacy_rows(quiz_xml: str) -> list[dict[str, Any]]:
+        """Rows of the questions of the XML which are valid for their type, others are left out."""
+        rows = []
+        for element in Wrapper.str_to_xml(data=quiz_xml).findall("question"):
+            question_type = (element.findtext("type") or "").strip().lower()
+            question_class = Wrapper.QUESTION_CLASSES.get(question_type)
+            if question_class is None or not question_class.is_valid(element=element):
+                logger.warning("Skipped an invalid question: %s", ElementTree.tostring(element)[:200])
+                continue
+            rows.append(Wrapper.get_question_row(element=element))
+        return rows
+
+    @staticmethod
+    def _add_questions(session, quiz_id: int, rows: list[dict[str, Any]]):
+        if not rows:
+            return
+        session.execute(sqlalchemy.insert(Question), [
+            {
+                "quiz_id": quiz_id,
+                "position": position,
+                "type": row["type"],
+                "text": row["text"],
+                "options": None if row["options"] is None else json.dumps(row["options"]),
+                "answers": json.dumps(row["answers"])
+            }
+            for position, row in enumerate(rows)
+        ])
+
     @contextmanager
     def session_scope(self):
         session = self.Session()
@@ -40,6 +231,15 @@ class Database:
         finally:
             session.close()  # Always close the session
 
+    @contextmanager
+    def read_scope(self):
+        """Session for lookups, which is closed without a commit."""
+        session = self.Session()
+        try:
+            yield session
+        finally:
+            session.close()
+
     @staticmethod
     def generate_unique_uuid(session):
         """Generate a unique UUID that is not already in the database."""
@@ -47,22 +247,176 @@ class Database:
             new_uuid = str(uuid.uuid4())  # Generate a new UUID
             # Check if the generated UUID already exists in the 'key' field
             existing_entry = session.query(Quiz).filter_by(key=new_uuid).first()
-            if not existing_entry:  # If no existing entry is found, it's unique
+            existing_job = session.query(Job).filter_by(key=new_uuid).first()
+            if not existing_entry and not existing_job:  # If no existing entry is found, it's unique
                 return new_uuid
 
+    def _add_quiz(self, session, key: str, name: str, quiz_xml: str):
+        rows = Wrapper.get_question_rows(xml_str=quiz_xml)
+        data, quiz_format = self.encode_quiz_xml(quiz_xml=Wrapper.rows_to_xml(rows=rows))
+        quiz = Quiz(key=key, name=name, quiz_xml=data, quiz_format=quiz_format, questions_migrated=True)
+        session.add(quiz)
+        session.flush()  # Assigns the id of the quiz
+        self._add_questions(session=session, quiz_id=quiz.id, rows=rows)
+
     def add_new_quiz(self, name: str, quiz_xml: str) -> str:
         with self.session_scope() as session:
             unique_key = self.generate_unique_uuid(session)
-            new_entry = Quiz(key=unique_key, name=name, quiz_xml=quiz_xml)
+            self._add_quiz(session=session, key=unique_key, name=name, quiz_xml=quiz_xml)
+        return unique_key
+
+    def add_new_job(self, name: str, file_name: str, file_data: bytes, question_number: int, difficulty: str,
+                    question_types: list[str], single_option_number: int, multiple_option_number: int) -> str:
+        """Queues generation of a quiz and returns the key under which the quiz will be available."""
+        now = time.time()
+        with self.session_scope() as session:
+            unique_key = self.generate_unique_uuid(session)
+            new_entry = Job(
+                key=unique_key,
+                name=name,
+                status=self.JOB_QUEUED,
+                file_name=file_name,
+                file_data=file_data,
+                question_number=question_number,
+                difficulty=difficulty,
+                question_types=json.dumps(question_types),
+                single_option_number=single_option_number,
+                multiple_option_number=multiple_option_number,
+                progress=0,
+                created_at=now,
+                updated_at=now
+            )
             session.add(new_entry)
         return unique_key
 
-    def get_quiz_by_key(self, key: str) -> dict[str, Any] | None:
+    def claim_next_job(self) -> dict[str, Any] | None:
+        """Marks the oldest queued job as running and returns it, `None` if there are no queued jobs."""
+        with self.session_scope() as session:
+            while True:
+                job = session.query(Job).filter_by(status=self.JOB_QUEUED).order_by(Job.id).first()
+                if job is None:
+                    return None
+
+                # Another worker (possibly in another process) may have claimed the same job in the meantime
+                claimed = session.query(Job).filter_by(id=job.id, status=self.JOB_QUEUED).update(
+                    {"status": self.JOB_RUNNING, "updated_at": time.time()}
+                )
+                if claimed:
+                    return {
+                        "key": job.key,
+                        "name": job.name,
+                        "file_name": job.file_name,
+                        "file_data": job.file_data,
+                        "question_number": job.question_number,
+                        "difficulty": job.difficulty,
+                        "question_types": json.loads(job.question_types),
+                        "single_option_number": job.single_option_number,
+                        "multiple_option_number": job.multiple_option_number
+                    }
+
+    def requeue_running_jobs(self, lease_timeout: float = config.JOB_LEASE_TIMEOUT) -> int:
+        """Puts jobs which were interrupted (e.g. by a restart of the server) back into the queue, those are running
+        jobs which were not updated for `lease_timeout` seconds."""
+        now = time.time()
+        with self.session_scope() as session:
+            return session.query(Job).filter(
+                Job.status == self.JOB_RUNNING,
+                Job.updated_at < now - lease_timeout
+            ).update({"status": self.JOB_QUEUED, "progress": 0, "updated_at": now})
+
+    def touch_jobs(self, keys: list[str]):
+        """Marks running jobs as alive, so they are not requeued."""
+        if not keys:
+            return
+        with self.session_scope() as session:
+            session.query(Job).filter(Job.key.in_(keys), Job.status == self.JOB_RUNNING).update(
+                {"updated_at": time.time()}
+            )
+
+    def update_job_progress(self, key: str, progress: int):
+        # Progress is reported from several threads, so it may arrive out of order
+        with self.session_scope() as session:
+            session.query(Job).filter(Job.key == key, Job.progress < progress).update(
+                {"progress": progress, "updated_at": time.time()}
+            )
+
+    def finish_job(self, key: str, quiz_xml: str):
+        """Stores the generated quiz under the key of the job."""
+        with self.session_scope() as session:
+            job = session.query(Job).filter_by(key=key).one()
+            self._add_quiz(session=session, key=key, name=job.name, quiz_xml=quiz_xml)
+
+            job.status = self.JOB_DONE
+            job.progress = job.question_number
+            job.file_data = None
+            job.updated_at = time.time()
+
+            session.query(Checkpoint).filter_by(run_id=key).delete()
+
+    def fail_job(self, key: str, error: str):
         with self.session_scope() as session:
-            result = session.query(Quiz).filter_by(key=key).first()
+            # The job may have been finished by another worker after it was requeued
+            session.query(Job).filter(Job.key == key, Job.status != self.JOB_DONE).update(
+                {"status": self.JOB_FAILED, "error": error, "file_data": None, "updated_at": time.time()}
+            )
+            session.query(Checkpoint).filter_by(run_id=key).delete()
+
+    def add_checkpoint(self, run_id: str, key: str, result: str):
+        with self.session_scope() as session:
+            # The same call may be finished twice if a run was retried while its previous attempt was still running
+            exists = session.query(Checkpoint).filter_by(run_id=run_id, key=key).first()
+            if not exists:
+                session.add(Checkpoint(run_id=run_id, key=key, result=result, created_at=time.time()))
+
+    def get_checkpoints(self, run_id: str) -> dict[str, str]:
+        """Results of LLM calls which were already finished in the generation run, by their keys."""
+        with self.read_scope() as session:
+            return dict(session.query(Checkpoint.key, Checkpoint.result).filter_by(run_id=run_id).all())
+
+    def get_job_by_key(self, key: str) -> dict[str, Any] | None:
+        with self.read_scope() as session:
+            result = session.query(Job).filter_by(key=key).first()
             if result:
                 return {
                     "name": result.name,
-                    "quiz_xml": result.quiz_xml
+                    "status": result.status,
+                    "progress": result.progress,
+                    "question_number": result.question_number,
+                    "error": result.error
+                }
+            return None
+
+    def get_quiz_by_key(self, key: str) -> dict[str, Any] | None:
+        """Name and number of questions of the quiz, its questions are read one by one with `get_question`."""
+        with self.read_scope() as session:
+            result = session.query(Quiz.id, Quiz.name, Quiz.questions_migrated).filter_by(key=key).first()
+            if result is None:
+                return None
+            if result.questions_migrated:
+                return {
+                    "name": result.name,
+                    "question_number": session.query(Question).filter_by(quiz_id=result.id).count()
+                }
+
+        # The quiz is opened before the background migration got to it
+        self.migrate_quiz_questions(quiz_id=result.id)
+        return self.get_quiz_by_key(key=key)
+
+    def get_question(self, key: str, position: int) -> dict[str, Any] | None:
+        """Question at `position` of the quiz, with the fields of `Wrapper.get_question_row`."""
+        with self.read_scope() as session:
+            result = session.query(Question).join(Quiz).filter(Quiz.key == key, Question.position == position).first()
+            if result:
+                return {
+                    "type": result.type,
+                    "text": result.text,
+                    "options": None if result.options is None else json.loads(result.options),
+                    "answers": json.loads(result.answers)
                 }
             return None
+
+    def get_quiz_xml(self, key: str) -> str | None:
+        """Quiz in the XML format used for export."""
+        with self.read_scope() as session:
+            result = session.query(Quiz.quiz_xml, Quiz.quiz_format).filter_by(key=key).first()
+            return self.decode_quiz_xml(data=result.quiz_xml, quiz_format=result.quiz_format) if result else None
@@ -1,29 +1,225 @@
 import re
+import json
 import math
+import time
+import uuid
 import random
+import hashlib
+import logging
+import itertools
+import threading
+from concurrent import futures
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator
 from xml.etree import ElementTree
 
+import anthropic
+import numpy as np
+
 import config
-from chain import Chain
-from wrapper import Wrapper
+from chain import Chain, LLMUsage
+from database import Database
+from latency import Hedge, HedgeStats, LatencyTracker
+from reader import Reader, TextChunkStream
+from sandbox import Sandbox
+from similarity import MinHashIndex, NoveltyFilter, Similarity
+from wrapper import ParseStats, Wrapper
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class GenerationReport:
+    # Wall-clock time until the question quota was filled
+    question_generation_time: float = 0.0
+    # Wall-clock time spent waiting for math answers after question generation was finished
+    math_solver_wait_time: float = 0.0
+    # Number of question generation requests and text chunks sent in them
+    request_number: int = 0
+    chunk_number: int = 0
+    # Estimated prompt tokens which were not sent thanks to packing several chunks into one request
+    saved_instruction_tokens: int = 0
+    saved_overlap_tokens: int = 0
+    # Sum of durations of individual math solver calls
+    math_solver_time: float = 0.0
+    math_problem_number: int = 0
+    math_solver_failures: int = 0
+    # Math answers which were taken from the output of the solver's code, runs of the code which gave no answer
+    # (so the one written by the model was used), and the time every run of the code took
+    math_executed_number: int = 0
+    math_execution_failures: int = 0
+    math_execution_times: list[float] = field(default_factory=list)
+    # Tokens of question generation (including streams cut off after the quota was filled) and math solver calls
+    usage: LLMUsage = field(default_factory=LLMUsage)
+    math_solver_usage: LLMUsage = field(default_factory=LLMUsage)
+    # Requests and math problems of a retried run whose results were restored from checkpoints
+    restored_request_number: int = 0
+    restored_math_problem_number: int = 0
+    # Questions which were parsed only after repairing their XML, questions which were malformed, unfinished
+    # or invalid for their type, and questions asked for again in follow-up requests
+    salvaged_question_number: int = 0
+    dropped_question_number: int = 0
+    follow_up_request_number: int = 0
+    re_requested_question_number: int = 0
+    # Questions which were rejected as near duplicates of questions already in the quiz (and replaced)
+    duplicate_question_number: int = 0
+    # Durations of question generation requests (except the ones cut off after the quota was filled), requests
+    # which were cut off by their deadline, and requests which were sent twice because they were slow to start
+    # together with the number of them which used the response of the duplicate
+    request_latencies: list[float] = field(default_factory=list)
+    timed_out_request_number: int = 0
+    hedged_request_number: int = 0
+    hedge_win_number: int = 0
+    # Questions of every type asked from LLM and the ones which made it into the quiz
+    requested_number_per_type: dict[str, int] = field(default_factory=dict)
+    used_number_per_type: dict[str, int] = field(default_factory=dict)
+
+
+@dataclass
+class MathSolution:
+    answer: str
+    # Duration of the solver call (including the run of its code)
+    duration: float = 0.0
+    failed: bool = False
+    usage: LLMUsage = field(default_factory=LLMUsage)
+    # Whether the answer is the output of the code, and how long the code ran (`None` if it was not run)
+    executed: bool = False
+    execution_time: float | None = None
+
+
+class InsufficientQuestionsError(RuntimeError):
+    """Generation gave too few questions. Retrying the run would restore the same responses from checkpoints
+    (and the cache), so it is not retried."""
+    pass
+
+
+class GenerationCheckpoints:
+    """Results of LLM calls finished in a generation run, kept in the database until the run is over,
+    so that a retry of the run repeats only the calls which did not finish."""
+
+    def __init__(self, database: Database | None = None, run_id: str | None = None):
+        self.database = database
+        self.run_id = run_id
+        self.enabled = database is not None and run_id is not None
+        self._results = database.get_checkpoints(run_id=run_id) if self.enabled else dict()
+
+    @staticmethod
+    def get_key(*parts) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        return self._results.get(key)
+
+    def put(self, key: str, result: str):
+        if self.enabled:
+            self.database.add_checkpoint(run_id=self.run_id, key=key, result=result)
+
+
+class QuestionQuota:
+    """Questions of every type which the quiz still needs, taking into account questions which were received
+    and the ones asked for in requests which are still running."""
+
+    def __init__(self, target_number_per_type: dict[str, int]):
+        self.target_number_per_type = target_number_per_type
+        self.received_number_per_type = dict.fromkeys(target_number_per_type, 0)
+        self.pending_number_per_type = dict.fromkeys(target_number_per_type, 0)
+
+    def _get_committed_number(self, question_type: str) -> int:
+        return self.received_number_per_type[question_type] + self.pending_number_per_type[question_type]
+
+    def get_outstanding_number(self) -> int:
+        return sum(
+            max(0, val - self._get_committed_number(question_type=key))
+            for key, val in self.target_number_per_type.items()
+        )
+
+    def allocate(self, question_number: int) -> dict[str, int]:
+        """Splits up to `question_number` questions between outstanding types, one at a time to the type which
+        is the furthest behind its share. Allocated questions are pending until they are released."""
+        target_sum = sum(self.target_number_per_type.values())
+        result = dict()
+        for _ in range(question_number):
+            candidates = [
+                key for key, val in self.target_number_per_type.items()
+                if self._get_committed_number(question_type=key) < val
+            ]
+            if not candidates:
+                break
+
+            committed_sum = sum(self._get_committed_number(question_type=x) for x in self.target_number_per_type)
+            question_type = max(candidates, key=lambda x: (
+                self.target_number_per_type[x] / target_sum * (committed_sum + 1) -
+                self._get_committed_number(question_type=x)
+            ))
+            self.pending_number_per_type[question_type] += 1
+            result[question_type] = result.get(question_type, 0) + 1
+        return result
+
+    def release(self, question_number_per_type: dict[str, int]):
+        for key, val in question_number_per_type.items():
+            self.pending_number_per_type[key] -= val
+
+    def add_received(self, question_type: str):
+        self.received_number_per_type[question_type] = self.received_number_per_type.get(question_type, 0) + 1
 
 
 class Generator:
-    def __init__(self):
-        self._chain = Chain()
+    def __init__(self, database: Database | None = None, chain: Chain | None = None):
+        self._chain = chain or Chain()
+        # Checkpoints of generation runs are stored only if a database is given
+        self.database = database
+        self._sandbox = Sandbox() if config.SANDBOX_ENABLED else None
+        # Latencies of recent question generation requests of all runs, the time to the first question sets
+        # when a slow request is hedged
+        self.request_latency = LatencyTracker()
+        self.first_question_latency = LatencyTracker()
+        self._hedge_lock = threading.Lock()
+        self._hedged_request_number = 0
+        self._tracked_request_number = 0
+
+    def get_hedge_delay(self) -> float | None:
+        """Time after which a request which gave no question yet is sent once more, `None` if it is not."""
+        if not config.GENERATION_HEDGE_PERCENTILE:
+            return None
+        if len(self.first_question_latency) < config.GENERATION_HEDGE_MIN_SAMPLES:
+            return None
+        return self.first_question_latency.get_percentile(percentile=config.GENERATION_HEDGE_PERCENTILE)
+
+    def get_latency_stats(self) -> dict[str, float | None]:
+        """Percentiles of the duration of recent question generation requests and the share of requests which
+        were hedged."""
+        with self._hedge_lock:
+            hedge_rate = self._hedged_request_number / max(1, self._tracked_request_number)
+        return {**self.request_latency.get_percentiles(), "hedge_rate": hedge_rate}
 
     @staticmethod
-    def get_question_per_chunk(question_number: int, chunk_number: int,
-                               current_chunk_size: int, average_chunk_size: float) -> int:
-        if question_number < chunk_number:
-            return 1
-        else:
-            coefficient = current_chunk_size / average_chunk_size
-            return math.ceil(coefficient * question_number / chunk_number)
+    def apportion(total: int, weights: dict) -> dict:
+        """Splits `total` into integers proportional to `weights` which add up exactly to `total`
+        (largest remainder method)."""
+        weight_sum = sum(weights.values())
+        quotas = dict((key, total * val / weight_sum) for key, val in weights.items())
+        result = dict((key, math.floor(val)) for key, val in quotas.items())
+        by_remainder = sorted(quotas, key=lambda x: quotas[x] - result[x], reverse=True)
+        for key in by_remainder[:total - sum(result.values())]:
+            result[key] += 1
+        return result
 
     def get_math_problem_answer_clean(self, math_problem: str) -> str:
+        model_answer = self._chain.math_solver(math_problem=math_problem).text
+        answer, _, _ = self.get_math_answer(model_answer=model_answer)
+        return answer
+
+    def get_math_answer(self, model_answer: str) -> tuple[str, bool, float | None]:
+        """Answer of a solver response, whether it was printed by its executed code (the model cannot run the code,
+        so the number it wrote is only used if the run fails) and the time the code ran."""
+        executed_answer, execution_time = self.execute_math_solution(model_answer=model_answer)
+        if executed_answer is not None:
+            return executed_answer, True, execution_time
+        return self.clean_math_problem_answer(model_answer=model_answer), False, execution_time
+
+    @staticmethod
+    def clean_math_problem_answer(model_answer: str) -> str:
         answer_tags = ("<answer>", "</answer>")
-        model_answer = self._chain.math_solver(math_problem=math_problem)
 
         answer = "empty"
         answer_start = model_answer.find(answer_tags[0]) + len(answer_tags[0])
@@ -35,22 +231,342 @@ class Generator:
                 answer = possible_answer.group()
         return answer
 
-    def add_answer_to_math_problems(self, questions: ElementTree.ElementTree) -> ElementTree.ElementTree:
-        for element in questions.findall("question"):
+    def execute_math_solution(self, model_answer: str) -> tuple[str | None, float | None]:
+        """Runs the Python code of a solver response and returns the number on the last line it printed (`None` if
+        the code is missing or fails or the line is not a single number) and the time it ran (`None` if it was not
+        run)."""
+        code = Sandbox.extract_code(text=model_answer)
+        if self._sandbox is None or code is None:
+            return None, None
+
+        result = self._sandbox.run(code=code)
+        if result.error is not None:
+            logger.info("Math solver code failed: %s", result.error)
+            return None, result.duration
+
+        lines = result.output.strip().splitlines()
+        if not lines or not re.fullmatch(pattern=Wrapper.get_float_regexp(), string=lines[-1].strip()):
+            return None, result.duration
+        return lines[-1].strip(), result.duration
+
+    def _solve_math_problem(self, math_problem: str, checkpoints: GenerationCheckpoints,
+                            client_id: str | None = None) -> MathSolution:
+        start = time.perf_counter()
+        try:
+            response = self._chain.math_solver(math_problem=math_problem, client_id=client_id)
+        except anthropic.APIError as e:
+            # Includes `APITimeoutError` raised after `MATH_SOLVER_TIMEOUT`
+            logger.warning("Math solver call failed: %r", e)
+            return MathSolution(answer="empty", duration=time.perf_counter() - start, failed=True)
+
+        answer, executed, execution_time = self.get_math_answer(model_answer=response.text)
+        solution = MathSolution(
+            answer=answer,
+            duration=time.perf_counter() - start,
+            usage=response.usage,
+            executed=executed,
+            execution_time=execution_time
+        )
+        checkpoints.put(key=checkpoints.get_key("math_solver", math_problem), result=solution.answer)
+        return solution
+
+    def _submit_math_problems(self, executor: futures.Executor, elements: list[ElementTree.Element],
+                              checkpoints: GenerationCheckpoints | None = None,
+                              report: GenerationReport | None = None,
+                              client_id: str | None = None) -> dict[futures.Future, ElementTree.Element]:
+        checkpoints = checkpoints or GenerationCheckpoints()
+        math_futures = dict()
+        for element in elements:
             element_type = element.find("type").text
             if element_type.lower() == "math problem":
-                answers = ElementTree.SubElement(element, "answers")
-                answer = ElementTree.SubElement(answers, "answer")
-                answer.text = self.get_math_problem_answer_clean(math_problem=element.find("text").text)
+                math_problem = element.find("text").text
+                answer = checkpoints.get(key=checkpoints.get_key("math_solver", math_problem))
+                if answer is not None:
+                    future = futures.Future()
+                    future.set_result(MathSolution(answer=answer))
+                    if report is not None:
+                        report.restored_math_problem_number += 1
+                else:
+                    future = executor.submit(self._solve_math_problem, math_problem=math_problem,
+                                             checkpoints=checkpoints, client_id=client_id)
+                math_futures[future] = element
+        return math_futures
+
+    @staticmethod
+    def _collect_math_answers(math_futures: dict[futures.Future, ElementTree.Element], report: GenerationReport):
+        for future in futures.as_completed(math_futures):
+            solution = future.result()
+
+            answers = ElementTree.SubElement(math_futures[future], "answers")
+            answer = ElementTree.SubElement(answers, "answer")
+            answer.text = solution.answer
+
+            report.math_problem_number += 1
+            report.math_solver_time += solution.duration
+            report.math_solver_failures += solution.failed
+            report.math_solver_usage.add(solution.usage)
+            if solution.execution_time is not None:
+                report.math_executed_number += solution.executed
+                report.math_execution_failures += not solution.executed
+                report.math_execution_times.append(solution.execution_time)
+
+    def add_answer_to_math_problems(self, questions: ElementTree.ElementTree,
+                                    report: GenerationReport | None = None) -> ElementTree.ElementTree:
+        with futures.ThreadPoolExecutor(max_workers=config.MATH_SOLVER_MAX_CONCURRENCY) as executor:
+            math_futures = self._submit_math_problems(executor=executor, elements=questions.findall("question"))
+            self._collect_math_answers(math_futures=math_futures, report=report or GenerationReport())
         return questions
 
-    def generate_questions(self, text_chunks: list[str], question_number: int, difficulty: str,
-                           question_types: list[str], single_option_number: int, multiple_option_number: int) -> str:
+    @staticmethod
+    def get_question_fingerprint(question: ElementTree.Element) -> str:
+        """Text by which questions are compared to find near duplicates."""
+        options = question.find("options")
+        option_texts = [] if options is None else sorted(x.text or "" for x in options.findall("option"))
+        return " ".join([question.find("text").text, *option_texts])
+
+    def _iter_request_questions(self, document: str, question_number_per_type: dict, difficulty: str,
+                                question_types: list[str], single_option_number: int, multiple_option_number: int,
+                                stop_event: threading.Event, usage: LLMUsage, stats: ParseStats,
+                                client_id: str | None = None, timeout: float | None = None,
+                                on_start: Callable[[], None] | None = None) -> Iterator[ElementTree.Element]:
+        """Yields valid questions of a request as soon as LLM finishes each of them, cutting the response off
+        once `stop_event` is set. Questions which are not valid for one of `question_types` are counted
+        in `stats` as dropped. Raises `TimeoutError` if the response is not finished within `timeout` seconds
+        after the call was sent, which also calls `on_start()` (time spent waiting for the rate limits before
+        does not count)."""
+        allowed_types = dict((x.lower(), x) for x in question_types)
+        deadline = None
+
+        def start():
+            nonlocal deadline
+            if timeout is not None:
+                deadline = time.perf_counter() + timeout
+            if on_start is not None:
+                on_start()
+
+        def is_running(_) -> bool:
+            if stop_event.is_set():
+                return False
+            if deadline is not None and time.perf_counter() > deadline:
+                raise TimeoutError("Question generation request was not finished in time")
+            return True
+
+        pieces = self._chain.stream_question_generation(
+            document=document,
+            question_number_per_type=question_number_per_type,
+            difficulty=difficulty,
+            question_types=question_types,
+            single_option_number=single_option_number,
+            multiple_option_number=multiple_option_number,
+            usage=usage,
+            client_id=client_id,
+            on_start=start
+        )
+        try:
+            pieces_until_stop = itertools.takewhile(is_running, pieces)
+            for question in Wrapper.iter_elements(pieces=pieces_until_stop, tag="question", stats=stats):
+                # Sections are only needed to let LLM know which part of the document a quota belongs to
+                section = question.find("section")
+                if section is not None:
+                    question.remove(section)
+
+                question_type = question.find("type")
+                question_type = None if question_type is None else (question_type.text or "").strip().lower()
+                if question_type not in allowed_types or not Wrapper.QUESTION_CLASSES[question_type].is_valid(question):
+                    stats.dropped += 1
+                    continue
+
+                question.find("type").text = allowed_types[question_type]
+                yield question
+        finally:
+            pieces.close()
+
+    def _iter_chunk_tasks(self, text_chunks: list[str] | TextChunkStream, question_number: int,
+                          rng: random.Random) -> Iterator[tuple[int, str, int]]:
+        """Yields text chunks in the order they are fed to LLM, together with their positions in the document
+        and the number of questions for each."""
+        if isinstance(text_chunks, TextChunkStream):
+            yield from self._iter_stream_chunk_tasks(text_chunks=text_chunks, question_number=question_number,
+                                                     rng=rng)
+            return
+
         chunk_number = len(text_chunks)
-        average_chunk_size = sum([len(x) for x in text_chunks]) / chunk_number
 
-        random_indexes = list(range(chunk_number))
-        random.shuffle(random_indexes)
+        if question_number < chunk_number:
+            # Only some chunks are needed, so the ones which differ the most from each other go first,
+            # the rest are a fallback in case selected ones do not give enough questions
+            signatures = Similarity.get_signatures(texts=text_chunks)
+            chunk_indexes = Similarity.order_by_diversity(signatures=signatures, selected_number=question_number,
+                                                          rng=rng)
+            for i in chunk_indexes:
+                yield i, text_chunks[i], 1
+            return
+
+        # Every chunk gets questions in proportion to its size
+        chunk_question_numbers = self.apportion(
+            total=question_number,
+            weights=dict((i, len(x)) for i, x in enumerate(text_chunks))
+        )
+        chunk_indexes = list(range(chunk_number))
+        rng.shuffle(chunk_indexes)
+        for i in chunk_indexes:
+            yield i, text_chunks[i], chunk_question_numbers[i]
+
+    def _iter_stream_chunk_tasks(self, text_chunks: TextChunkStream, question_number: int,
+                                 rng: random.Random) -> Iterator[tuple[int, str, int]]:
+        # Chunks are fed to LLM as soon as they are read, evenly spread over the estimated length of the document,
+        # and so are questions. A chunk which repeats an already used one gives its turn (and questions)
+        # to the next novel chunk
+        offset = rng.random()
+        novelty_filter = NoveltyFilter()
+        owed_chunk_number, owed_question_number = 0, 0
+        deferred_chunks, deferred_signatures = [], []
+
+        for i, current_chunk in enumerate(text_chunks):
+            chunk_number = max(text_chunks.estimate_chunk_number(), i + 1)
+            selected_chunk_number = min(question_number, chunk_number)
+
+            owed_chunk_number += (math.floor((i + 1) * selected_chunk_number / chunk_number + offset) -
+                                  math.floor(i * selected_chunk_number / chunk_number + offset))
+            owed_question_number += (math.floor((i + 1) * question_number / chunk_number + offset) -
+                                     math.floor(i * question_number / chunk_number + offset))
+
+            signature = Similarity.get_signatures(texts=[current_chunk])[0]
+            if owed_chunk_number > 0 and novelty_filter.is_novel(signature=signature):
+                chunk_question_number = math.ceil(owed_question_number / owed_chunk_number)
+                owed_chunk_number -= 1
+                owed_question_number -= chunk_question_number
+                novelty_filter.add(signature=signature)
+                yield i, current_chunk, chunk_question_number
+            else:
+                deferred_chunks.append((i, current_chunk))
+                deferred_signatures.append(signature)
+
+        if not deferred_chunks:
+            return
+
+        # Skipped chunks are used only if selected ones did not give enough questions, the most novel ones first
+        chunk_indexes = Similarity.order_by_diversity(
+            signatures=np.stack(deferred_signatures),
+            selected_number=owed_chunk_number,
+            selected_signatures=novelty_filter.signatures,
+            rng=rng
+        )
+        chunk_question_number = math.ceil(question_number / text_chunks.chunk_count)
+        for i in chunk_indexes:
+            chunk_index, current_chunk = deferred_chunks[i]
+            yield chunk_index, current_chunk, chunk_question_number
+
+    def _iter_request_tasks(self, chunk_tasks: Iterable[tuple[int, str, int]], overhead_tokens: int,
+                            max_question_number: int) -> Iterator[list[tuple[int, str, int]]]:
+        """Packs consecutive chunk tasks into requests which fit into the prompt and output token budgets
+        and ask for no more than `max_question_number` questions. Questions of a chunk which asks for more are
+        split over several requests with the same chunk."""
+        max_question_number = min(max_question_number, config.LLM_MAX_OUTPUT_TOKENS // config.QUESTION_TOKEN_ESTIMATE)
+        max_question_number = max(1, max_question_number)
+        request_tasks = []
+        request_tokens, request_question_number = overhead_tokens, 0
+
+        for task in self._split_chunk_tasks(chunk_tasks=chunk_tasks, max_question_number=max_question_number):
+            _, current_chunk, chunk_question_number = task
+            chunk_tokens = self._chain.estimate_tokens(text=current_chunk)
+
+            request_question_number += chunk_question_number
+            if request_tasks and (
+                    request_tokens + chunk_tokens > config.REQUEST_TOKEN_BUDGET or
+                    request_question_number > max_question_number
+            ):
+                yield request_tasks
+                request_tasks = []
+                request_tokens, request_question_number = overhead_tokens, chunk_question_number
+
+            request_tasks.append(task)
+            request_tokens += chunk_tokens
+
+        if request_tasks:
+            yield request_tasks
+
+    @staticmethod
+    def _split_chunk_tasks(chunk_tasks: Iterable[tuple[int, str, int]],
+                           max_question_number: int) -> Iterator[tuple[int, str, int]]:
+        """Chunk tasks with at most `max_question_number` questions each, larger ones are split evenly."""
+        for index, current_chunk, chunk_question_number in chunk_tasks:
+            part_number = math.ceil(chunk_question_number / max_question_number)
+            if part_number <= 1:
+                yield index, current_chunk, chunk_question_number
+                continue
+            for i in range(part_number):
+                part_question_number = chunk_question_number // part_number + (i < chunk_question_number % part_number)
+                yield index, current_chunk, part_question_number
+
+    @staticmethod
+    def _get_request_sections(
+            request_tasks: list[tuple[int, str, dict[str, int]]]
+    ) -> tuple[list[tuple[str, dict[str, int]]], int]:
+        """Sections of a request in document order and the number of characters saved on chunk overlaps.
+
+        Chunks which follow each other in the document are merged into one section without their common overlap.
+        """
+        sections = []
+        saved_overlap_size = 0
+        previous_index = None
+
+        for index, current_chunk, question_number_per_type in sorted(request_tasks, key=lambda x: x[0]):
+            if sections and index == previous_index + 1:
+                text, section_question_number_per_type = sections[-1]
+                overlap_size = Reader.get_overlap_size(previous_chunk=text, next_chunk=current_chunk)
+                saved_overlap_size += overlap_size
+
+                sections[-1] = (
+                    text + (current_chunk[overlap_size:] if overlap_size else "\n" + current_chunk),
+                    dict(
+                        (key, section_question_number_per_type.get(key, 0) + question_number_per_type.get(key, 0))
+                        for key in {**section_question_number_per_type, **question_number_per_type}
+                    )
+                )
+            else:
+                sections.append((current_chunk, question_number_per_type))
+            previous_index = index
+
+        return sections, saved_overlap_size
+
+    def _get_follow_up_document(self, chunk_tasks: list[tuple[int, str, int]], start: int,
+                                overhead_tokens: int) -> tuple[str, int]:
+        """Text of chunks which were already sent to LLM, starting from `start`, fitting into the request token
+        budget. Returns the document and the position of the first chunk which did not fit."""
+        request_tokens = overhead_tokens
+        stop = start
+        while stop < start + len(chunk_tasks):
+            request_tokens += self._chain.estimate_tokens(text=chunk_tasks[stop % len(chunk_tasks)][1])
+            if stop > start and request_tokens > config.REQUEST_TOKEN_BUDGET:
+                break
+            stop += 1
+
+        request_tasks = [chunk_tasks[i % len(chunk_tasks)] for i in range(start, stop)]
+        sections, _ = self._get_request_sections(request_tasks=request_tasks)
+        return "\n".join(text for text, _ in sections), stop % len(chunk_tasks)
+
+    def generate_questions(self, text_chunks: list[str] | TextChunkStream, question_number: int, difficulty: str,
+                           question_types: list[str], single_option_number: int, multiple_option_number: int,
+                           report: GenerationReport | None = None,
+                           progress_callback: Callable[[int], None] | None = None,
+                           run_id: str | None = None, seed: str | None = None) -> str:
+        """`progress_callback` is called with the number of questions generated so far whenever it grows.
+
+        Results of finished LLM calls are checkpointed under `run_id` (if the generator has a database), calling
+        the method again with the same `run_id` and arguments sends only the calls which did not finish before.
+
+        Chunks are selected, ordered and packed into requests by a random generator seeded with `seed` (`run_id`
+        if it is not given), so runs with the same seed send the same requests, which can be answered from cache.
+        """
+        report = report or GenerationReport()
+        start = time.perf_counter()
+
+        # Chunks are picked in the same order by every attempt of a run, so its requests match the checkpoints
+        rng = random.Random(seed if seed is not None else run_id)
+        checkpoints = GenerationCheckpoints(database=self.database, run_id=run_id)
+        # Calls of the run take turns with calls of other runs in the LLM scheduler
+        client_id = run_id if run_id is not None else uuid.uuid4().hex
 
         result_xml = Wrapper.get_tree()
         result_xml_root = result_xml.getroot()
@@ -59,50 +575,269 @@ class Generator:
         current_question_type_dist = dict(
             (key, val) for key, val in current_question_type_dist.items() if key in question_types
         )
-        current_question_type_dist = dict(
-            (key, val / sum(current_question_type_dist.values())) for key, val in current_question_type_dist.items()
+        # Questions of every type are counted for the whole quiz, requests ask only for the ones still outstanding
+        quota = QuestionQuota(target_number_per_type=self.apportion(
+            total=question_number,
+            weights=current_question_type_dist
+        ))
+        sent_chunk_tasks = []
+        # Duplicates are not counted as received, so the quota asks for replacements
+        duplicate_index = MinHashIndex()
+
+        executor = futures.ThreadPoolExecutor(max_workers=config.GENERATION_MAX_CONCURRENCY)
+        math_executor = futures.ThreadPoolExecutor(max_workers=config.MATH_SOLVER_MAX_CONCURRENCY)
+        math_futures = dict()
+        pending = set()
+
+        # Questions are added to the result by generation threads as soon as they are streamed
+        result_lock = threading.Lock()
+        stop_event = threading.Event()
+
+        overhead_tokens = self._chain.estimate_question_generation_overhead(
+            difficulty=difficulty,
+            question_types=question_types,
+            single_option_number=single_option_number,
+            multiple_option_number=multiple_option_number
         )
 
-        # Text chunks are fed to LLM in random order
-        for i in random_indexes:
-            current_chunk = text_chunks[i]
+        def iter_request_questions(checkpoint_key: str, stats: ParseStats, **kwargs) -> Iterator[ElementTree.Element]:
+            checkpoint = checkpoints.get(key=checkpoint_key)
+            if checkpoint is not None:
+                with result_lock:
+                    report.restored_request_number += 1
+                yield from Wrapper.str_to_xml(checkpoint).findall("question")
+                return
 
-            question_per_chunk = self.get_question_per_chunk(
-                question_number=question_number,
-                chunk_number=chunk_number,
-                average_chunk_size=average_chunk_size,
-                current_chunk_size=len(current_chunk)
-            )
+            # Every attempt of a hedged request parses its own response, only the stats of the used one count
+            attempt_stats = dict()
 
-            question_number_per_type_per_chunk = dict(
-                (key, math.ceil(val * question_per_chunk)) for key, val in current_question_type_dist.items()
-            )
+            def start_attempt(attempt: int, admitted: Callable[[], None]) -> Iterator[ElementTree.Element]:
+                attempt_usage = LLMUsage()
+                attempt_stats[attempt] = ParseStats()
+                try:
+                    yield from self._iter_request_questions(
+                        stop_event=stop_event,
+                        usage=attempt_usage,
+                        stats=attempt_stats[attempt],
+                        client_id=client_id,
+                        timeout=config.GENERATION_REQUEST_TIMEOUT,
+                        on_start=admitted,
+                        **kwargs
+                    )
+                finally:
+                    # The attempt which was not used is closed by its own thread, possibly after the request ended
+                    with result_lock:
+                        report.usage.add(attempt_usage)
+
+            request_start = time.perf_counter()
+            hedge_stats = HedgeStats()
+            request_xml = Wrapper.get_tree()
+            try:
+                for question in Hedge.iter_first_response(start=start_attempt, hedge_delay=self.get_hedge_delay(),
+                                                          stats=hedge_stats):
+                    request_xml.getroot().append(question)
+                    yield question
+            except (TimeoutError, anthropic.APITimeoutError) as e:
+                # Questions of the request which were already received are kept, other requests ask for the rest
+                logger.warning("Question generation request timed out: %r", e)
+                with result_lock:
+                    report.timed_out_request_number += 1
+            else:
+                # Questions are checkpointed only once the whole response is received
+                if not stop_event.is_set():
+                    checkpoints.put(key=checkpoint_key, result=Wrapper.xml_to_str(data=request_xml))
+            finally:
+                if hedge_stats.winner is not None:
+                    stats.add(attempt_stats[hedge_stats.winner])
+                if hedge_stats.first_item_latency is not None:
+                    self.first_question_latency.add(hedge_stats.first_item_latency)
+                with result_lock:
+                    report.hedged_request_number += hedge_stats.hedged
+                    report.hedge_win_number += hedge_stats.winner == 1
+                    if not stop_event.is_set():
+                        report.request_latencies.append(time.perf_counter() - request_start)
+                        self.request_latency.add(report.request_latencies[-1])
+                with self._hedge_lock:
+                    self._tracked_request_number += 1
+                    self._hedged_request_number += hedge_stats.hedged
+
+        def generate_request(allocated_number_per_type: dict[str, int], **kwargs):
+            stats = ParseStats()
+            try:
+                for question in iter_request_questions(stats=stats, **kwargs):
+                    signature = duplicate_index.get_signature(text=self.get_question_fingerprint(question=question))
+                    with result_lock:
+                        if stop_event.is_set():
+                            break
+                        if not duplicate_index.is_novel(signature=signature):
+                            report.duplicate_question_number += 1
+                            continue
+                        duplicate_index.add(signature=signature)
+
+                        # Math problems are solved in the background while other questions are generated
+                        math_futures.update(self._submit_math_problems(
+                            executor=math_executor,
+                            elements=[question],
+                            checkpoints=checkpoints,
+                            report=report,
+                            client_id=client_id
+                        ))
+                        result_xml_root.append(question)
+                        quota.add_received(question_type=question.find("type").text)
+                        result_len = len(result_xml_root)
+                        if result_len >= question_number:
+                            stop_event.set()
+
+                    if progress_callback is not None:
+                        progress_callback(result_len)
+            finally:
+                with result_lock:
+                    quota.release(question_number_per_type=allocated_number_per_type)
+                    report.salvaged_question_number += stats.repaired
+                    # The last question of a response which was cut off is always unfinished
+                    report.dropped_question_number += stats.dropped + stats.truncated * (not stop_event.is_set())
+
+        def submit_request(request_tasks: list[tuple[int, str, int]]) -> futures.Future | None:
+            allocated_number_per_type = dict()
+            with result_lock:
+                # Chunks get only questions which are still outstanding, chunks without any are not sent
+                request_tasks = [
+                    (index, current_chunk, quota.allocate(question_number=chunk_question_number))
+                    for index, current_chunk, chunk_question_number in request_tasks
+                ]
+            request_tasks = [x for x in request_tasks if x[2]]
+            if not request_tasks:
+                return None
+            for _, _, chunk_number_per_type in request_tasks:
+                for key, val in chunk_number_per_type.items():
+                    allocated_number_per_type[key] = allocated_number_per_type.get(key, 0) + val
+                    report.requested_number_per_type[key] = report.requested_number_per_type.get(key, 0) + val
 
-            current_questions = self._chain.question_generation(
-                document=current_chunk,
-                question_number_per_type=question_number_per_type_per_chunk,
+            sections, saved_overlap_size = self._get_request_sections(request_tasks=request_tasks)
+            if len(sections) == 1:
+                document, question_number_per_type = sections[0]
+            else:
+                document = "\n".join(
+                    f'<section id="{i}">\n{text}\n</section>' for i, (text, _) in enumerate(sections, start=1)
+                )
+                question_number_per_type = dict(
+                    (str(i), section_question_number_per_type)
+                    for i, (_, section_question_number_per_type) in enumerate(sections, start=1)
+                )
+
+            sent_chunk_tasks.extend(request_tasks)
+            report.request_number += 1
+            report.chunk_number += len(request_tasks)
+            report.saved_instruction_tokens += (len(request_tasks) - 1) * overhead_tokens
+            report.saved_overlap_tokens += self._chain.estimate_tokens(text=" " * saved_overlap_size)
+
+            return executor.submit(
+                generate_request,
+                allocated_number_per_type=allocated_number_per_type,
+                checkpoint_key=checkpoints.get_key("question_generation", [x[0] for x in request_tasks]),
+                document=document,
+                question_number_per_type=question_number_per_type,
                 difficulty=difficulty,
-                question_types=question_types,
+                question_types=[x for x in question_types if x in allocated_number_per_type],
                 single_option_number=single_option_number,
                 multiple_option_number=multiple_option_number
             )
 
-            current_questions = Wrapper.str_to_xml(data=current_questions)
-            current_questions = self.add_answer_to_math_problems(questions=current_questions)
-            current_len = len(current_questions.findall("question"))
+        # Requests are sent to LLM at most `GENERATION_MAX_CONCURRENCY` at a time
+        try:
+            chunk_tasks = self._iter_chunk_tasks(text_chunks=text_chunks, question_number=question_number, rng=rng)
+            # Questions are spread over the first requests, so that they are generated in parallel
+            request_tasks = self._iter_request_tasks(
+                chunk_tasks=chunk_tasks,
+                overhead_tokens=overhead_tokens,
+                max_question_number=math.ceil(question_number / config.GENERATION_MAX_CONCURRENCY)
+            )
+            while True:
+                # Next chunks are taken only while running requests do not cover all outstanding questions,
+                # otherwise they are kept as a fallback for requests which do not give enough
+                while len(pending) < config.GENERATION_MAX_CONCURRENCY:
+                    with result_lock:
+                        outstanding_number = quota.get_outstanding_number()
+                    task = next(request_tasks, None) if outstanding_number > 0 else None
+                    if task is None:
+                        break
+                    future = submit_request(task)
+                    if future is not None:
+                        pending.add(future)
 
-            # Trying to stop generation early
-            result_len = len(result_xml.findall("question"))
-            if result_len + current_len > question_number:
-                result_xml_root.extend(current_questions.findall("question")[:question_number - result_len])
-                break
+                if not pending:
+                    break
+                done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+
+                for future in done:
+                    future.result()
+
+                if stop_event.is_set():
+                    break
+
+            # All chunks were used, but some questions were dropped or not generated, so only the missing ones
+            # are asked for again, based on the same text
+            follow_up_start = 0
+            for i in range(config.GENERATION_MAX_FOLLOW_UP_REQUESTS):
+                if not sent_chunk_tasks:
+                    break
+                with result_lock:
+                    missing_number_per_type = quota.allocate(question_number=question_number - len(result_xml_root))
+                if not missing_number_per_type:
+                    break
+
+                document, follow_up_start = self._get_follow_up_document(
+                    chunk_tasks=sent_chunk_tasks,
+                    start=follow_up_start,
+                    overhead_tokens=overhead_tokens
+                )
+                report.follow_up_request_number += 1
+                report.re_requested_question_number += sum(missing_number_per_type.values())
+                for key, val in missing_number_per_type.items():
+                    report.requested_number_per_type[key] = report.requested_number_per_type.get(key, 0) + val
+
+                executor.submit(
+                    generate_request,
+                    allocated_number_per_type=missing_number_per_type,
+                    checkpoint_key=checkpoints.get_key("follow_up", i),
+                    document=document,
+                    question_number_per_type=missing_number_per_type,
+                    difficulty=difficulty,
+                    question_types=list(missing_number_per_type),
+                    single_option_number=single_option_number,
+                    multiple_option_number=multiple_option_number
+                ).result()
+
+            # Requests which are still in flight are not needed anymore, their streams stop at the next piece
+            executor.shutdown(wait=False, cancel_futures=True)
+            report.question_generation_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with result_lock:
+                math_futures = dict(math_futures)
+            self._collect_math_answers(math_futures=math_futures, report=report)
+            report.math_solver_wait_time = time.perf_counter() - start
+
+        except Exception:
+            if checkpoints.enabled:
+                # Requests which are already running are paid for, so they are finished and checkpointed for a retry
+                executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+        finally:
+            stop_event.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            math_executor.shutdown(wait=False, cancel_futures=True)
 
-            result_xml_root.extend(current_questions.getroot())
+        for question in result_xml_root:
+            question_type = question.find("type").text
+            report.used_number_per_type[question_type] = report.used_number_per_type.get(question_type, 0) + 1
 
-        # Failsafe: Ensure the requested number of questions is met
-        result_len = len(result_xml.findall("question"))
+        result_len = len(result_xml_root)
+        if result_len < max(1, math.ceil(question_number * config.GENERATION_MIN_QUESTION_SHARE)):
+            raise InsufficientQuestionsError(f"Only {result_len} of {question_number} questions were generated")
         if result_len < question_number:
-            duplicates = random.sample(population=result_xml_root.findall("question"), k=question_number - result_len)
-            result_xml_root.extend(duplicates)
+            logger.warning("Only %d of %d questions were generated", result_len, question_number)
 
+        logger.info("Generation finished: %s", report)
         return Wrapper.xml_to_str(data=result_xml)
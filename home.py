@@ -4,8 +4,8 @@ import streamlit as st
 
 import config
 from database import Database
-from generator import Generator
-from reader import Reader
+from jobs import get_job_worker_pool
+from resources import ResourceStats, get_database
 
 
 class Home:
@@ -15,16 +15,19 @@ class Home:
         self._init_session_variables()
         self._define_custom_css()
 
-        self.database = Database()
-        self.generator = Generator()
-        self.reader = Reader()
+        # Shared objects are built by the first rerun of the process, later reruns only look them up
+        with ResourceStats.track_setup(page="home"):
+            self.database = get_database()
+            self.job_worker_pool = get_job_worker_pool()
 
     @staticmethod
     def _init_session_variables():
         # Initialize session variables if they do not exist
         default_values = {
             "show_generator": True,
-            "quiz_pool": []
+            "quiz_pool": [],
+            # Name, link and key of the quiz submitted last, shown until the next one (also after reruns)
+            "submitted_quiz": None
         }
         for key, value in default_values.items():
             st.session_state.setdefault(key, value)
@@ -44,6 +47,39 @@ class Home:
         st.code(link, language="text")
         st.link_button(label="Go To Quiz", url=link)
 
+    def _display_job_status(self, key: str):
+        job = self.database.get_job_by_key(key=key)
+        if job is None:
+            return
+
+        # Only jobs which can still change are polled
+        if job["status"] in (Database.JOB_QUEUED, Database.JOB_RUNNING):
+            self._poll_job_status(key=key)
+        else:
+            self._show_job_status(job=job)
+
+    @st.fragment(run_every=config.JOB_POLL_INTERVAL)
+    def _poll_job_status(self, key: str):
+        job = self.database.get_job_by_key(key=key)
+        if job["status"] not in (Database.JOB_QUEUED, Database.JOB_RUNNING):
+            # The page is rerun to show the final status without the polling fragment
+            st.rerun()
+        self._show_job_status(job=job)
+
+    @staticmethod
+    def _show_job_status(job: dict):
+        if job["status"] == Database.JOB_QUEUED:
+            st.progress(0, text="Waiting in queue...")
+        elif job["status"] == Database.JOB_RUNNING:
+            st.progress(
+                job["progress"] / job["question_number"],
+                text=f"Generated {job['progress']} of {job['question_number']} questions..."
+            )
+        elif job["status"] == Database.JOB_DONE:
+            st.success("Quiz is ready!")
+        else:
+            st.error("Quiz generation failed, please try again.")
+
     @staticmethod
     def _toggle_show_generator_flag():
         st.session_state.show_generator = not st.session_state.show_generator
@@ -53,10 +89,11 @@ class Home:
         st.button(label="Go Back", on_click=self._toggle_show_generator_flag)
 
         if len(st.session_state.quiz_pool):
-            for name, link in st.session_state.quiz_pool[::-1]:
+            for name, link, key in st.session_state.quiz_pool[::-1]:
                 with st.container(border=True):
                     st.write(name)
                     self._display_quiz_link(link=link)
+                    self._display_job_status(key=key)
 
     def _build_page(self):
         st.title("Quiz Generator")
@@ -125,29 +162,29 @@ class Home:
                 elif not multiple_option_number:
                     st.warning(body=f"Please select '{multiple_option_number_label}'!", icon="⚠️")
                 else:
-                    with st.spinner("Loading..."):
-                        text = self.reader.process_file(file=file)
-                        text_chunks = self.reader.get_text_chunks(text=text)
-
-                        quiz_xml = self.generator.generate_questions(
-                            text_chunks=text_chunks,
-                            question_number=question_number,
-                            difficulty=difficulty,
-                            question_types=question_types,
-                            single_option_number=single_option_number,
-                            multiple_option_number=multiple_option_number
-                        )
-
-                        key = self.database.add_new_quiz(quiz_xml=quiz_xml, name=name)
-                        link = urljoin(st.secrets["BASE_URL"], f"quiz?key={key}")
-
-                        st.session_state.quiz_pool.append(
-                            (name, link)
-                        )
-
-                        st.markdown("""___""")
-                        st.subheader("Link for generated quiz", anchor=False)
-                        self._display_quiz_link(link=link)
+                    # Quiz is generated in the background, the link works once the generation is finished
+                    key = self.job_worker_pool.submit(
+                        name=name,
+                        file=file,
+                        question_number=question_number,
+                        difficulty=difficulty,
+                        question_types=question_types,
+                        single_option_number=single_option_number,
+                        multiple_option_number=multiple_option_number
+                    )
+                    link = urljoin(st.secrets["BASE_URL"], f"quiz?key={key}")
+
+                    st.session_state.quiz_pool.append(
+                        (name, link, key)
+                    )
+                    st.session_state.submitted_quiz = (name, link, key)
+
+        if st.session_state.submitted_quiz is not None:
+            _, link, key = st.session_state.submitted_quiz
+            st.markdown("""___""")
+            st.subheader("Link for generated quiz", anchor=False)
+            self._display_quiz_link(link=link)
+            self._display_job_status(key=key)
 
         if len(st.session_state.quiz_pool):
             st.button(label="Show History", on_click=self._toggle_show_generator_flag)
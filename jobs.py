@@ -0,0 +1,182 @@
+import io
+import json
+import time
+import hashlib
+import logging
+import threading
+import functools
+
+import streamlit as st
+
+import config
+from database import Database
+from generator import Generator, InsufficientQuestionsError
+from reader import Reader
+from reader import TextChunkStream
+from resources import get_database, get_generator, get_reader
+
+logger = logging.getLogger(__name__)
+
+
+class JobWorkerPool:
+    """Threads which generate quizzes of queued jobs from the database, one job per thread at a time."""
+
+    def __init__(self, database: Database, generator: Generator, reader: Reader, max_concurrency: int):
+        self.database = database
+        self.generator = generator
+        self.reader = reader
+        self.max_concurrency = max_concurrency
+
+        self._condition = threading.Condition()
+        self._threads = []
+        # Keys of the jobs run by this pool at the moment
+        self._running_keys = set()
+
+    def start(self):
+        self._requeue_expired_jobs()
+        threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+
+        # Questions of quizzes stored by older versions are migrated without holding up the start
+        threading.Thread(target=self._migrate_quizzes, name="quiz-migrator", daemon=True).start()
+
+        for i in range(self.max_concurrency):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _requeue_expired_jobs(self):
+        # Jobs which are running in another live process are kept alive by its heartbeat
+        requeued = self.database.requeue_running_jobs()
+        if requeued:
+            logger.info("Requeued %d interrupted jobs", requeued)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(config.JOB_HEARTBEAT_INTERVAL)
+            try:
+                with self._condition:
+                    keys = list(self._running_keys)
+                self.database.touch_jobs(keys=keys)
+                self._requeue_expired_jobs()
+            except Exception:
+                logger.exception("Job heartbeat failed")
+
+    def _migrate_quizzes(self):
+        try:
+            migrated = self.database.migrate_quiz_questions()
+        except Exception:
+            # Quizzes which were not migrated are tried again at the next start (or when they are opened)
+            logger.exception("Migration of quiz questions failed")
+            return
+        if migrated:
+            logger.info("Migrated questions of %d stored quizzes", migrated)
+
+    def submit(self, name: str, file: io.BytesIO, question_number: int, difficulty: str, question_types: list[str],
+               single_option_number: int, multiple_option_number: int) -> str:
+        """Queues generation of a quiz and returns its key, the quiz can be opened once the job is done."""
+        key = self.database.add_new_job(
+            name=name,
+            file_name=file.name,
+            file_data=file.getvalue(),
+            question_number=question_number,
+            difficulty=difficulty,
+            question_types=question_types,
+            single_option_number=single_option_number,
+            multiple_option_number=multiple_option_number
+        )
+        with self._condition:
+            self._condition.notify()
+        return key
+
+    def _work(self):
+        while True:
+            try:
+                job = self.database.claim_next_job()
+            except Exception:
+                # E.g. the database is locked for a moment, the worker tries again later
+                logger.exception("Claiming the next job failed")
+                job = None
+            if job is None:
+                # Jobs may also be queued by other processes, so the queue is polled even without notifications
+                with self._condition:
+                    self._condition.wait(timeout=config.JOB_POLL_INTERVAL)
+                continue
+
+            with self._condition:
+                self._running_keys.add(job["key"])
+            try:
+                self._run_job(job=job)
+            except Exception:
+                # The job stays running and is requeued once its lease expires
+                logger.exception("Job %s could not be finished", job["key"])
+            finally:
+                with self._condition:
+                    self._running_keys.discard(job["key"])
+
+    def _run_job(self, job: dict):
+        for attempt in range(1, config.JOB_MAX_ATTEMPTS + 1):
+            try:
+                quiz_xml = self._generate_quiz(job=job)
+                self.database.finish_job(key=job["key"], quiz_xml=quiz_xml)
+                return
+
+            except Exception as e:
+                logger.exception("Job %s failed (attempt %d of %d)", job["key"], attempt, config.JOB_MAX_ATTEMPTS)
+                # A retry would restore the same short result from checkpoints
+                if attempt == config.JOB_MAX_ATTEMPTS or isinstance(e, InsufficientQuestionsError):
+                    self.database.fail_job(key=job["key"], error=repr(e))
+                    return
+                time.sleep(config.JOB_RETRY_DELAY * attempt)
+
+    def _update_progress(self, key: str, progress: int):
+        # Progress is only informative, failing to store it does not stop the generation
+        try:
+            self.database.update_job_progress(key=key, progress=progress)
+        except Exception:
+            logger.exception("Progress of job %s was not updated", key)
+
+    @staticmethod
+    def get_generation_seed(job: dict) -> str:
+        """Same for every job of the same file and generation parameters, so their requests can hit the LLM cache."""
+        parameters = [job[x] for x in (
+            "question_number", "difficulty", "question_types", "single_option_number", "multiple_option_number"
+        )]
+        data = job["file_data"] + json.dumps(parameters).encode("utf-8")
+        return hashlib.sha256(data).hexdigest()
+
+    def _generate_quiz(self, job: dict) -> str:
+        file = io.BytesIO(job["file_data"])
+        file.name = job["file_name"]
+
+        text_chunks = self.reader.load_text_chunks(file=file)
+
+        # The key of the job identifies the generation run, so retries (also after a restart) resume from checkpoints
+        quiz_xml = self.generator.generate_questions(
+            text_chunks=text_chunks,
+            question_number=job["question_number"],
+            difficulty=job["difficulty"],
+            question_types=job["question_types"],
+            single_option_number=job["single_option_number"],
+            multiple_option_number=job["multiple_option_number"],
+            progress_callback=functools.partial(self._update_progress, job["key"]),
+            run_id=job["key"],
+            seed=self.get_generation_seed(job=job)
+        )
+
+        if isinstance(text_chunks, TextChunkStream) and self.reader.cache is not None:
+            threading.Thread(target=text_chunks.drain, daemon=True).start()
+
+        return quiz_xml
+
+
+@st.cache_resource
+def get_job_worker_pool() -> JobWorkerPool:
+    """Worker pool shared by all sessions of the server process."""
+    pool = JobWorkerPool(
+        database=get_database(),
+        generator=get_generator(),
+        reader=get_reader(),
+        max_concurrency=config.JOB_MAX_CONCURRENCY
+    )
+    pool.start()
+    return pool
@@ -0,0 +1,120 @@
+import time
+import queue
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Iterator, TypeVar
+
+import numpy as np
+
+import config
+
+T = TypeVar("T")
+
+
+class LatencyTracker:
+    """Latencies (in seconds) of the last `window` calls, added and read from any thread."""
+
+    def __init__(self, window: int = config.GENERATION_LATENCY_WINDOW):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+    def add(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def get_percentile(self, percentile: float) -> float | None:
+        """`None` if no latencies were added yet."""
+        with self._lock:
+            latencies = list(self._latencies)
+        return float(np.percentile(latencies, percentile)) if latencies else None
+
+    def get_percentiles(self, percentiles: tuple[float, ...] = (50, 95, 99)) -> dict[str, float | None]:
+        return dict((f"p{x}", self.get_percentile(percentile=x)) for x in percentiles)
+
+
+@dataclass
+class HedgeStats:
+    hedged: bool = False
+    # Attempt whose response was used (1 for the duplicate)
+    winner: int | None = None
+    # Time from the start of the used attempt until its first item
+    first_item_latency: float | None = None
+
+
+class Hedge:
+    @staticmethod
+    def iter_first_response(start: Callable[[int, Callable[[], None]], Iterator[T]], hedge_delay: float | None,
+                            stats: HedgeStats) -> Iterator[T]:
+        """Yields the items of `start(0, admitted)`. If it gives no item within `hedge_delay` seconds after it calls
+        `admitted()` (once its call is actually sent, e.g. after waiting for the rate limits), a duplicate
+        `start(1, admitted)` is started and the items of the attempt which gives its first item sooner are yielded,
+        while the other attempt is closed (`None` disables hedging).
+
+        An attempt which fails or gives no items is only used if the other attempt did not give an item either."""
+        results = queue.Queue()
+        decided = threading.Event()
+
+        def run(attempt: int):
+            attempt_start = time.perf_counter()
+
+            def admitted():
+                nonlocal attempt_start
+                attempt_start = time.perf_counter()
+                results.put((attempt, ("admitted", None), None, 0.0))
+
+            iterator = None
+            try:
+                iterator = start(attempt, admitted)
+                outcome = ("item", next(iterator))
+            except StopIteration:
+                outcome = ("done", None)
+            except Exception as e:
+                outcome = ("error", e)
+            results.put((attempt, outcome, iterator, time.perf_counter() - attempt_start))
+
+            # The iterator is continued by the caller if it won, it cannot be closed there while this thread runs it
+            decided.wait()
+            if stats.winner != attempt and iterator is not None:
+                iterator.close()
+
+        threading.Thread(target=run, args=(0,), daemon=True).start()
+        running = 1
+        # The duplicate is started `hedge_delay` seconds after the first attempt was admitted
+        hedge_at = None
+        try:
+            while True:
+                timeout = None
+                if not stats.hedged and hedge_at is not None:
+                    timeout = max(0.0, hedge_at - time.perf_counter())
+                try:
+                    attempt, (kind, value), iterator, latency = results.get(timeout=timeout)
+                except queue.Empty:
+                    stats.hedged = True
+                    threading.Thread(target=run, args=(1,), daemon=True).start()
+                    running += 1
+                    continue
+
+                if kind == "admitted":
+                    if attempt == 0 and hedge_delay is not None:
+                        hedge_at = time.perf_counter() + hedge_delay
+                    continue
+
+                running -= 1
+                if kind == "item" or running == 0:
+                    break
+            stats.winner = attempt
+            if kind == "item":
+                stats.first_item_latency = latency
+        finally:
+            decided.set()
+
+        if kind == "error":
+            raise value
+        if kind == "done":
+            return
+        yield value
+        yield from iterator
@@ -1,15 +1,17 @@
-import re
 import random
+import functools
 
 import streamlit as st
-import numpy as np
 
+import config
 from database import Database
+from resources import ResourceStats, get_database, get_quiz_cache
 from wrapper import BaseQuestion
 from wrapper import MathProblemQuestion
 from wrapper import MultipleCorrectQuestion
 from wrapper import NoChoiceQuestion
 from wrapper import SingleCorrectQuestion
+from wrapper import StoredQuiz
 from wrapper import TrueFalseQuestion
 from wrapper import Wrapper
 
@@ -21,15 +23,30 @@ class Quiz:
         self._init_session_variables()
         self._define_custom_css()
 
-        self.database = Database()
-
         self.name = "Quiz"
         self.quiz = None
-        if "key" in st.query_params.keys():
-            result = self.database.get_quiz_by_key(key=st.query_params["key"])
-            if result:
-                self.name = result["name"]
-                self.quiz = Wrapper(xml_str=result["quiz_xml"], seed=st.session_state.seed)
+        self.job = None
+        with ResourceStats.track_setup(page="quiz"):
+            self.database = get_database()
+            if "key" in st.query_params.keys():
+                key = st.query_params["key"]
+                # Every session shares the loaded questions and only shuffles their order
+                stored_quiz = get_quiz_cache().get(key=key, load=functools.partial(self._load_quiz, key=key))
+                if stored_quiz is not None:
+                    self.name = stored_quiz.name
+                    self.quiz = Wrapper.from_questions(questions=stored_quiz, seed=st.session_state.seed)
+                else:
+                    self.job = self.database.get_job_by_key(key=st.query_params["key"])
+
+    def _load_quiz(self, key: str) -> StoredQuiz | None:
+        result = self.database.get_quiz_by_key(key=key)
+        if result is None:
+            return None
+        return StoredQuiz(
+            name=result["name"],
+            question_number=result["question_number"],
+            load_question=functools.partial(self.database.get_question, key)
+        )
 
     @staticmethod
     def _init_session_variables():
@@ -81,22 +98,20 @@ class Quiz:
             st.warning(f"Partially correct answer. Should be: {answers}")
 
     def _handle_question_display_and_logic(self, question: BaseQuestion) -> tuple[list, list[bool], float]:
-        question_data = question.get_data()
-
         selected_options = []
         correct_ones = []
         current_score = 0
 
         # Display the question and answer options
         st.subheader(f"Question {st.session_state.current_index + 1} out of {len(self.quiz)}")
-        st.write(f"{question_data['text']}")
+        st.write(f"{question.text}")
         st.markdown("""___""")
 
         # Answer selection
         if type(question) is TrueFalseQuestion:
             options = ["True", "False"]
             options_lower = [x.lower() for x in options]
-            answer = question_data["answer"]
+            answer = question.answer
 
             if st.session_state.answer_submitted:
                 user_choice = st.radio(
@@ -122,13 +137,13 @@ class Quiz:
                     selected_options = [user_choice]
                     correct_ones = [False]
                     current_score = 0
-                    if user_choice.lower() == answer.lower():
+                    if question.is_correct(choice=user_choice):
                         correct_ones = [True]
                         current_score = 1
 
         elif type(question) is SingleCorrectQuestion:
-            options = question_data["options"]
-            answer = question_data["answer"]
+            options = list(question.options)
+            answer = question.answer
 
             if st.session_state.answer_submitted:
                 user_choice = st.radio(
@@ -151,13 +166,13 @@ class Quiz:
                     selected_options = [user_choice]
                     correct_ones = [False]
                     current_score = 0
-                    if user_choice == answer:
+                    if question.is_correct(choice=user_choice):
                         correct_ones = [True]
                         current_score = 1
 
         elif type(question) is MultipleCorrectQuestion:
-            options = question_data["options"]
-            answers = question_data["answers"]
+            options = question.options
+            answers = list(question.answers)
 
             if st.session_state.answer_submitted:
                 user_choice = [st.checkbox(
@@ -173,18 +188,18 @@ class Quiz:
                         is_selected = user_choice[i]
                         if is_selected:
                             selected_options.append(options[i])
-                            current_score += 1 if options[i] in answers else 0
+                            current_score += 1 if question.is_correct(option=options[i]) else 0
 
                     correct_ones = [False for _ in range(len(selected_options))]
                     current_score = 0
                     for i in range(len(selected_options)):
-                        if selected_options[i] in answers:
+                        if question.is_correct(option=selected_options[i]):
                             correct_ones[i] = True
                             current_score += 1
                     current_score /= len(answers)
 
         elif type(question) is NoChoiceQuestion:
-            answer = question_data["answer"]
+            answer = question.answer
 
             if st.session_state.answer_submitted:
                 user_choice = st.text_input(
@@ -208,12 +223,12 @@ class Quiz:
                     selected_options = [user_choice]
                     correct_ones = [False]
                     current_score = 0
-                    if user_choice.lower() == answer.lower():
+                    if question.is_correct(choice=user_choice):
                         correct_ones = [True]
                         current_score = 1
 
         elif type(question) is MathProblemQuestion:
-            answer = question_data["answer"]
+            answer = question.answer
 
             if st.session_state.answer_submitted:
                 user_choice = st.text_input(
@@ -237,20 +252,18 @@ class Quiz:
                     selected_options = [user_choice]
                     correct_ones = [False]
                     current_score = 0
-                    user_choice_val = re.search(pattern=Wrapper.get_float_regexp(), string=user_choice)
-                    answer_val = re.search(pattern=Wrapper.get_float_regexp(), string=answer)
-                    if user_choice_val and answer_val:
-                        user_choice_val = user_choice_val.group()
-                        answer_val = answer_val.group()
-                        if np.isclose(a=float(user_choice_val), b=float(answer_val), rtol=1e-4, atol=1e-4):
-                            correct_ones = [True]
-                            current_score = 1
+                    if question.is_correct(choice=user_choice):
+                        correct_ones = [True]
+                        current_score = 1
 
         return selected_options, correct_ones, current_score
 
     def _build_page(self):
         # Title and description and metric
         st.title(self.name)
+        if not len(self.quiz):
+            st.subheader("This quiz has no questions")
+            return
         total_percentage = round(100 * st.session_state.score / len(self.quiz), 2)
 
         if st.session_state.current_index >= len(self.quiz):
@@ -295,13 +308,38 @@ class Quiz:
         st.title("This Quiz dont exist!")
         st.subheader(f"Check if your link is valid")
 
+    def _quiz_in_progress(self):
+        st.title(self.job["name"])
+        # Only jobs which can still change are polled
+        if self.job["status"] in (Database.JOB_QUEUED, Database.JOB_RUNNING):
+            self._poll_job_status()
+        elif self.job["status"] == Database.JOB_FAILED:
+            st.subheader("Generation of this quiz failed")
+        else:
+            st.subheader("This quiz is not available")
+
+    @st.fragment(run_every=config.JOB_POLL_INTERVAL)
+    def _poll_job_status(self):
+        job = self.database.get_job_by_key(key=st.query_params["key"])
+        if job["status"] not in (Database.JOB_QUEUED, Database.JOB_RUNNING):
+            # The page is rerun to show the quiz (or the final status) without the polling fragment
+            st.rerun()
+
+        st.subheader("This quiz is still being generated")
+        st.progress(
+            job["progress"] / job["question_number"],
+            text=f"Generated {job['progress']} of {job['question_number']} questions..."
+        )
+
     @staticmethod
     def _build_quiz_pool():
         print(st.session_state.quiz_pool)
 
     def run(self):
-        if self.quiz:
+        if self.quiz is not None:
             self._build_page()
+        elif self.job:
+            self._quiz_in_progress()
         else:
             self._quiz_dont_exist()
 
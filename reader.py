@@ -1,90 +1,388 @@
 import io
+import os
+import json
+import math
+import hashlib
+import tempfile
+import collections
+import multiprocessing
+from concurrent import futures
+from typing import Iterable, Iterator
 
 from docx import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from pypdf import PageObject
 from pypdf import PdfReader
 
 import config
 
 
-class ProcessPDF:
+class TextNormalizer:
     @staticmethod
-    def fix_paragraphs(text: str) -> str:
-        return (text
-                .replace(".\n", ".\n\n")
-                .replace("?\n", "?\n\n")
-                .replace("!\n", "!\n\n"))
+    def apply_rules(rules: Iterable[tuple[str, str]], text: str) -> str:
+        """Applies ordered `(old, new)` replacement rules to the text."""
+        for old, new in rules:
+            text = text.replace(old, new)
+        return text
 
-    @staticmethod
-    def fix_whitespaces(text: str) -> str:
-        return (text
-                .replace(" \n", " ")
-                .replace("\xa0", " "))
 
-    @staticmethod
-    def fix_hyphen_usage(text: str) -> str:
-        return (text
-                .replace("–", "-")
-                .replace(" -\n", "")
-                .replace("-\n", "-"))
+class ProcessPDF:
+    WHITESPACE_RULES = ((" \n", " "), ("\xa0", " "))
+    PARAGRAPH_RULES = ((".\n", ".\n\n"), ("?\n", "?\n\n"), ("!\n", "!\n\n"))
+    HYPHEN_RULES = (("–", "-"), (" -\n", ""), ("-\n", "-"))
+    SLASH_RULES = (("/\n", "/"),)
+
+    @classmethod
+    def fix_paragraphs(cls, text: str) -> str:
+        return TextNormalizer.apply_rules(rules=cls.PARAGRAPH_RULES, text=text)
+
+    @classmethod
+    def fix_whitespaces(cls, text: str) -> str:
+        return TextNormalizer.apply_rules(rules=cls.WHITESPACE_RULES, text=text)
+
+    @classmethod
+    def fix_hyphen_usage(cls, text: str) -> str:
+        return TextNormalizer.apply_rules(rules=cls.HYPHEN_RULES, text=text)
+
+    @classmethod
+    def fix_slash_usage(cls, text: str) -> str:
+        return TextNormalizer.apply_rules(rules=cls.SLASH_RULES, text=text)
+
+    @classmethod
+    def get_normalization_rules(cls) -> tuple[tuple[str, str], ...]:
+        return (
+            cls.WHITESPACE_RULES
+            + cls.PARAGRAPH_RULES
+            + cls.HYPHEN_RULES
+            + cls.SLASH_RULES
+            + tuple(config.PDF_EXTRA_NORMALIZATION_RULES)
+        )
+
+    @classmethod
+    def extract_page(cls, page: PageObject) -> str:
+        raw_text = page.extract_text(extraction_mode="plain")
+        return TextNormalizer.apply_rules(rules=cls.get_normalization_rules(), text=raw_text)
+
+    @classmethod
+    def iter_pages(cls, reader: PdfReader) -> Iterator[str]:
+        for page in reader.pages:
+            yield cls.extract_page(page=page)
 
     @staticmethod
-    def fix_slash_usage(text: str) -> str:
-        return text.replace("/\n", "/")
+    def iter_pages_parallel(data: bytes, page_number: int, processes: int) -> Iterator[str]:
+        """Same as `iter_pages`, but page ranges are extracted in separate processes (pages still come in order)."""
+        # Forking a process with running threads (Streamlit) is not safe, so workers are forked from a fork server,
+        # which imports this module only once per application run. Platforms without it (Windows) spawn the workers
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context("forkserver")
+            mp_context.set_forkserver_preload([__name__])
+        else:
+            mp_context = multiprocessing.get_context("spawn")
+
+        executor = futures.ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=mp_context,
+            initializer=_init_pdf_worker,
+            initargs=(data,)
+        )
+        try:
+            starts = range(0, page_number, config.PDF_PAGES_PER_TASK)
+            stops = [min(x + config.PDF_PAGES_PER_TASK, page_number) for x in starts]
+            for pages in executor.map(_extract_pdf_pages, starts, stops):
+                yield from pages
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
     @classmethod
     def read_pdf(cls, data: io.BytesIO) -> str:
-        result = ""
+        return "".join(cls.iter_pages(reader=PdfReader(data)))
+
+
+# PDF which is processed by the current worker process of `ProcessPDF.iter_pages_parallel`
+_worker_pdf_reader: PdfReader | None = None
 
-        reader = PdfReader(data)
-        for page in reader.pages:
-            raw_text = page.extract_text(extraction_mode="plain")
 
-            raw_text = cls.fix_whitespaces(text=raw_text)
-            raw_text = cls.fix_paragraphs(text=raw_text)
-            raw_text = cls.fix_hyphen_usage(text=raw_text)
-            raw_text = cls.fix_slash_usage(text=raw_text)
+def _init_pdf_worker(data: bytes):
+    global _worker_pdf_reader
+    _worker_pdf_reader = PdfReader(io.BytesIO(data))
 
-            result += raw_text
 
-        return result
+def _extract_pdf_pages(start: int, stop: int) -> list[str]:
+    return [ProcessPDF.extract_page(page=_worker_pdf_reader.pages[i]) for i in range(start, stop)]
 
 
 class ProcessDOCX:
     @staticmethod
-    def read_docx(data: io.BytesIO) -> str:
-        doc = Document(data)
-
-        result = ""
+    def iter_paragraphs(doc: Document) -> Iterator[str]:
         for para in doc.paragraphs:
-            result += para.text
-        return result
+            yield para.text
+
+    @classmethod
+    def read_docx(cls, data: io.BytesIO) -> str:
+        return "".join(cls.iter_paragraphs(doc=Document(data)))
+
+
+class ReaderCache:
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def get_fingerprint(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, name: str) -> list[str] | None:
+        path = os.path.join(self.path, name)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                values = [json.loads(line) for line in f]
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        os.utime(path)  # Modification time is used as the last access time for eviction
+        return values
+
+    def write_through(self, name: str, values: Iterable[str]) -> Iterator[str]:
+        """Yields `values` and stores them under `name` once all of them were consumed."""
+        # Values go to a temporary file first, so an abandoned iteration never leaves a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                for value in values:
+                    f.write(json.dumps(value) + "\n")
+                    yield value
+            os.replace(temp_path, os.path.join(self.path, name))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+class TextChunkStream:
+    """Text chunks of a document which is still being read.
+
+    Chunks are produced one by one while pages (or paragraphs) are extracted, and the total number of chunks
+    is estimated from the part of the document which was already read.
+    """
+
+    def __init__(self, pieces: Iterable[str], piece_number: int, cache: ReaderCache | None = None,
+                 cache_name: str | None = None):
+        self.piece_number = piece_number
+        self.chunk_count = 0
+        self.exhausted = False
+
+        # Progress is kept outside of `self`, so dropping an unfinished stream does not leave a reference cycle
+        self._progress = {"piece_count": 0, "text_size": 0}
+        self._chunks = Reader.iter_text_chunks(pieces=self._count_pieces(pieces=pieces, progress=self._progress))
+        if cache is not None:
+            self._chunks = cache.write_through(name=cache_name, values=self._chunks)
+
+    @staticmethod
+    def _count_pieces(pieces: Iterable[str], progress: dict[str, int]) -> Iterator[str]:
+        for piece in pieces:
+            progress["piece_count"] += 1
+            progress["text_size"] += len(piece)
+            yield piece
+
+    @property
+    def piece_count(self) -> int:
+        return self._progress["piece_count"]
+
+    @property
+    def text_size(self) -> int:
+        return self._progress["text_size"]
+
+    def __iter__(self) -> Iterator[str]:
+        return self
+
+    def __next__(self) -> str:
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self.exhausted = True
+            raise
+        self.chunk_count += 1
+        return chunk
+
+    def drain(self):
+        """Reads the rest of the document, so that it gets into cache even if generation stopped early."""
+        for _ in self:
+            pass
+
+    def estimate_chunk_number(self) -> int:
+        if self.exhausted or self.piece_count == 0:
+            return self.chunk_count
+
+        estimated_text_size = self.text_size / self.piece_count * self.piece_number
+        chunk_step = config.TEXT_CHUNK_SIZE - config.TEXT_CHUNK_OVERLAP
+        return max(self.chunk_count, math.ceil(estimated_text_size / chunk_step))
 
 
 class Reader:
+    def __init__(self, cache: ReaderCache | None = None):
+        if cache is None and config.READER_CACHE_ENABLED:
+            cache = ReaderCache(path=config.READER_CACHE_PATH, max_size=config.READER_CACHE_MAX_SIZE)
+        self.cache = cache
+
     @staticmethod
     def get_extension_type(filename: str) -> str:
         return filename.split(".")[-1]
 
     @classmethod
-    def process_file(cls, file: io.BytesIO) -> str:
+    def open_file(cls, file: io.BytesIO) -> tuple[Iterator[str], int]:
+        """Returns lazily extracted text pieces (pages or paragraphs) of the file and the number of pieces."""
         data_type = cls.get_extension_type(filename=file.name)
 
         if data_type in config.ALLOWED_FILE_TYPES:
             if data_type == "txt":
-                return file.getvalue().decode("utf-8")
+                return iter([file.getvalue().decode("utf-8")]), 1
             elif data_type == "pdf":
-                return ProcessPDF.read_pdf(data=io.BytesIO(file.getvalue()))
+                reader = PdfReader(io.BytesIO(file.getvalue()))
+                page_number = len(reader.pages)
+
+                # Starting worker processes costs more than extracting a short document in place
+                processes = min(config.PDF_EXTRACTION_PROCESSES, math.ceil(page_number / config.PDF_PAGES_PER_TASK))
+                if page_number >= config.PDF_PARALLEL_MIN_PAGES and processes > 1:
+                    pages = ProcessPDF.iter_pages_parallel(
+                        data=file.getvalue(),
+                        page_number=page_number,
+                        processes=processes
+                    )
+                    return pages, page_number
+
+                return ProcessPDF.iter_pages(reader=reader), page_number
             elif data_type == "docx":
-                return ProcessDOCX.read_docx(data=io.BytesIO(file.getvalue()))
+                doc = Document(io.BytesIO(file.getvalue()))
+                return ProcessDOCX.iter_paragraphs(doc=doc), len(doc.paragraphs)
 
         else:
             raise TypeError(f"Wrong file extension `{data_type}`. Allowed extensions: {config.ALLOWED_FILE_TYPES}")
 
+    @classmethod
+    def process_file(cls, file: io.BytesIO) -> str:
+        pieces, _ = cls.open_file(file=file)
+        return "".join(pieces)
+
     @staticmethod
-    def get_text_chunks(text: str) -> list[str]:
-        text_splitter = RecursiveCharacterTextSplitter(
+    def get_text_splitter() -> RecursiveCharacterTextSplitter:
+        return RecursiveCharacterTextSplitter(
+            separators=config.TEXT_CHUNK_SEPARATORS,
             chunk_size=config.TEXT_CHUNK_SIZE,
             chunk_overlap=config.TEXT_CHUNK_OVERLAP
         )
-        return text_splitter.split_text(text)
+
+    @classmethod
+    def get_text_chunks(cls, text: str) -> list[str]:
+        return cls.get_text_splitter().split_text(text)
+
+    @staticmethod
+    def get_overlap_size(previous_chunk: str, next_chunk: str) -> int:
+        """Length of the longest beginning of `next_chunk` which repeats the end of `previous_chunk`."""
+        for size in range(min(len(previous_chunk), len(next_chunk), config.TEXT_CHUNK_OVERLAP), 0, -1):
+            # Overlap ends on a split of the text, which is never in the middle of a word
+            if not previous_chunk.endswith(next_chunk[:size]):
+                continue
+            if size == len(next_chunk) or not next_chunk[size].isalnum():
+                return size
+        return 0
+
+    @staticmethod
+    def iter_text_parts(pieces: Iterable[str], separator: str) -> Iterator[str]:
+        """Cuts text before every separator, the way the text splitter does, and yields the non-empty parts (each one
+        starting with its separator) as soon as they are complete."""
+        buffer = ""
+        # Separators found before this position of the buffer are already cut
+        search_start = 0
+        for piece in pieces:
+            buffer += piece
+            while (cut := buffer.find(separator, search_start)) > -1:
+                if cut > 0:
+                    yield buffer[:cut]
+                    buffer = buffer[cut:]
+                search_start = len(separator)
+            # A separator may begin at the end of the buffer and continue in the next piece
+            search_start = max(search_start, len(buffer) - len(separator) + 1)
+
+        if buffer:
+            yield buffer
+
+    @classmethod
+    def iter_text_chunks(cls, pieces: Iterable[str]) -> Iterator[str]:
+        """Splits text into the same chunks as `get_text_chunks`, but on the fly, keeping no more than a couple of
+        chunks of text in memory.
+
+        Parts of the text between the first separators are merged into chunks the way the text splitter merges them,
+        parts longer than a chunk are passed to the splitter. A text without the first separator is split at once.
+        """
+        text_splitter = cls.get_text_splitter()
+
+        # Parts of the next chunk and their total length
+        parts = collections.deque()
+        size = 0
+        for part in cls.iter_text_parts(pieces=pieces, separator=config.TEXT_CHUNK_SEPARATORS[0]):
+            if len(part) >= config.TEXT_CHUNK_SIZE:
+                if chunk := "".join(parts).strip():
+                    yield chunk
+                parts.clear()
+                size = 0
+                yield from text_splitter.split_text(part)
+                continue
+
+            if parts and size + len(part) > config.TEXT_CHUNK_SIZE:
+                if chunk := "".join(parts).strip():
+                    yield chunk
+                # The end of the chunk which fits into the overlap (and leaves space for the part) starts the next one
+                while size > config.TEXT_CHUNK_OVERLAP or (size + len(part) > config.TEXT_CHUNK_SIZE and size > 0):
+                    size -= len(parts.popleft())
+            parts.append(part)
+            size += len(part)
+
+        if chunk := "".join(parts).strip():
+            yield chunk
+
+    def load_text_chunks(self, file: io.BytesIO) -> list[str] | TextChunkStream:
+        """Text chunks of the file, reusing results for files which were seen before.
+
+        Files which are not in cache are read lazily, while the returned stream is consumed.
+        """
+        if self.cache is None:
+            pieces, piece_number = self.open_file(file=file)
+            return TextChunkStream(pieces=pieces, piece_number=piece_number)
+
+        data_type = self.get_extension_type(filename=file.name)
+        fingerprint = f"{self.cache.get_fingerprint(data=file.getvalue())}-{data_type}"
+        text_name = f"{fingerprint}.text.jsonl"
+        chunks_name = f"{fingerprint}-{config.TEXT_CHUNK_SIZE}-{config.TEXT_CHUNK_OVERLAP}.chunks.jsonl"
+
+        text_chunks = self.cache.get(name=chunks_name)
+        if text_chunks is not None:
+            return text_chunks
+
+        pieces = self.cache.get(name=text_name)
+        if pieces is not None:
+            piece_number = len(pieces)
+        else:
+            pieces, piece_number = self.open_file(file=file)
+            pieces = self.cache.write_through(name=text_name, values=pieces)
+
+        return TextChunkStream(pieces=pieces, piece_number=piece_number, cache=self.cache, cache_name=chunks_name)
@@ -0,0 +1,95 @@
+import time
+import logging
+import functools
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, TypeVar
+
+import streamlit as st
+
+from chain import Chain
+from database import Database
+from generator import Generator
+from latency import LatencyTracker
+from reader import Reader
+from wrapper import QuizCache
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ResourceStats:
+    """Number of times every shared resource was built in the process (more than once means it is not shared)
+    and how long recent page reruns spent before rendering, by page."""
+
+    _lock = threading.Lock()
+    _construction_numbers = Counter()
+    _setup_times = dict()
+
+    @classmethod
+    def add_construction(cls, name: str):
+        with cls._lock:
+            cls._construction_numbers[name] += 1
+
+    @classmethod
+    @contextmanager
+    def track_setup(cls, page: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with cls._lock:
+                tracker = cls._setup_times.setdefault(page, LatencyTracker())
+            tracker.add(time.perf_counter() - start)
+
+    @classmethod
+    def get_stats(cls) -> dict:
+        with cls._lock:
+            construction_numbers = dict(cls._construction_numbers)
+            setup_times = dict(cls._setup_times)
+        return {
+            "construction_numbers": construction_numbers,
+            "setup_times": dict((key, val.get_percentiles()) for key, val in setup_times.items())
+        }
+
+
+def shared_resource(function: Callable[[], T]) -> Callable[[], T]:
+    """Builds the resource once per server process, every session and rerun gets the same object."""
+
+    @functools.wraps(function)
+    def build() -> T:
+        start = time.perf_counter()
+        resource = function()
+        ResourceStats.add_construction(name=function.__name__)
+        logger.info("Built %s in %.3f s", function.__name__, time.perf_counter() - start)
+        return resource
+
+    return st.cache_resource(build)
+
+
+@shared_resource
+def get_database() -> Database:
+    return Database()
+
+
+@shared_resource
+def get_chain() -> Chain:
+    """Chain with the LLM client, which keeps its HTTP connections alive between calls of all sessions."""
+    return Chain()
+
+
+@shared_resource
+def get_generator() -> Generator:
+    return Generator(database=get_database(), chain=get_chain())
+
+
+@shared_resource
+def get_reader() -> Reader:
+    return Reader()
+
+
+@shared_resource
+def get_quiz_cache() -> QuizCache:
+    return QuizCache()
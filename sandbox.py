@@ -0,0 +1,172 @@
+import io
+import os
+import re
+import sys
+import time
+import shutil
+import signal
+import tempfile
+import threading
+import subprocess
+from dataclasses import dataclass
+
+import config
+
+# Runs in the child process before the code: limits its resources (where the platform supports it), forbids new
+# processes, sockets and opening files outside the working directory and the Python installation, and executes
+# the code read from stdin as the main module. The audit hook only stops accidental access, code can get around it
+# (isolation comes from `SANDBOX_ISOLATION_COMMAND` and `SANDBOX_USER`)
+PRELUDE = """
+import os
+import sys
+try:
+    import resource
+    cpu_time, memory = int(sys.argv[1]), int(sys.argv[2])
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_time, cpu_time))
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+    resource.setrlimit(resource.RLIMIT_NPROC, (0, 0))
+except ImportError:
+    pass
+
+allowed_paths = tuple(os.path.realpath(x) + os.sep for x in {os.getcwd(), sys.prefix, sys.base_prefix})
+blocked_events = ("os.exec", "os.fork", "os.posix_spawn", "os.spawn", "os.system", "subprocess.", "socket.")
+
+def audit(event, args):
+    if event.startswith(blocked_events):
+        raise PermissionError(f"{event} is not allowed")
+    if event == "open" and isinstance(args[0], (str, bytes)):
+        path = os.path.realpath(os.fsdecode(args[0]))
+        if not (path + os.sep).startswith(allowed_paths):
+            raise PermissionError(f"{path} is not allowed")
+
+sys.addaudithook(audit)
+code = sys.stdin.read()
+exec(compile(code, "<solution>", "exec"), {"__name__": "__main__"})
+"""
+
+
+@dataclass
+class ExecutionResult:
+    output: str
+    # Last line of stderr of a failed execution, `None` if the code finished successfully
+    error: str | None
+    duration: float
+
+
+class Sandbox:
+    """Runs untrusted Python code in separate interpreter processes with limited time, memory and no file writes,
+    at most `max_processes` at a time. Every execution gets a fresh process and an empty working directory.
+
+    The process can still read what the server user can read and reach the network unless it is started under
+    `isolation_command` (e.g. nsjail or `unshare`) and as another `user` (the server must run as root for that)."""
+
+    def __init__(self, max_processes: int = config.SANDBOX_MAX_PROCESSES, timeout: float = config.SANDBOX_TIMEOUT,
+                 memory_limit: int = config.SANDBOX_MEMORY_LIMIT,
+                 max_output_size: int = config.SANDBOX_MAX_OUTPUT_SIZE,
+                 isolation_command: tuple[str, ...] = config.SANDBOX_ISOLATION_COMMAND,
+                 user: str | None = config.SANDBOX_USER):
+        self.timeout = timeout
+        self.isolation_command = isolation_command
+        self.user = user
+        self.memory_limit = memory_limit
+        self.max_output_size = max_output_size
+        self._semaphore = threading.BoundedSemaphore(max_processes)
+
+    @staticmethod
+    def extract_code(text: str) -> str | None:
+        """The last fenced Python block of the text."""
+        blocks = re.findall(r"```(?:python|py)?[ \t]*\n(.*?)```", text, flags=re.DOTALL)
+        return blocks[-1] if blocks else None
+
+    def run(self, code: str) -> ExecutionResult:
+        # Only variables limiting native thread pools are passed, the rest of the environment stays private
+        env = {"PATH": os.environ.get("PATH", ""), "OMP_NUM_THREADS": "1", "OPENBLAS_NUM_THREADS": "1"}
+        command = [
+            *self.isolation_command,
+            sys.executable, "-I", "-c", PRELUDE, str(max(1, round(self.timeout))), str(self.memory_limit)
+        ]
+
+        with self._semaphore, tempfile.TemporaryDirectory() as directory:
+            if self.user is not None:
+                shutil.chown(directory, user=self.user)
+            start = time.perf_counter()
+            # The child leads its own process group, so processes it starts are killed together with it
+            process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=directory,
+                env=env,
+                user=self.user,
+                start_new_session=True
+            )
+            # Pipes are read as the output arrives, so the server never holds more than the limit of it
+            stdout, stderr = bytearray(), bytearray()
+            output_exceeded = threading.Event()
+            threads = [
+                threading.Thread(target=self._write_input, args=(process, code), daemon=True),
+                threading.Thread(target=self._read_output, args=(process, process.stdout, stdout, output_exceeded),
+                                 daemon=True),
+                threading.Thread(target=self._read_output, args=(process, process.stderr, stderr, None), daemon=True)
+            ]
+            for thread in threads:
+                thread.start()
+
+            timed_out = False
+            try:
+                process.wait(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                timed_out = True
+            finally:
+                self._kill_group(process)
+                process.wait()
+            for thread in threads:
+                thread.join(timeout=1)
+            process.stdout.close()
+            process.stderr.close()
+            duration = time.perf_counter() - start
+
+        if timed_out:
+            return ExecutionResult(output="", error="TimeoutExpired", duration=duration)
+        if output_exceeded.is_set():
+            return ExecutionResult(output="", error="Output limit exceeded", duration=duration)
+
+        output = stdout.decode("utf-8", errors="replace")
+        if process.returncode != 0:
+            error_lines = stderr.decode("utf-8", errors="replace").strip().splitlines()
+            error_lines = error_lines or [f"exit code {process.returncode}"]
+            return ExecutionResult(output=output, error=error_lines[-1], duration=duration)
+        return ExecutionResult(output=output, error=None, duration=duration)
+
+    @staticmethod
+    def _write_input(process: subprocess.Popen, code: str):
+        try:
+            process.stdin.write(code.encode("utf-8"))
+            process.stdin.close()
+        except (BrokenPipeError, OSError):
+            # The child exited (or was killed) before reading all of its input
+            pass
+
+    def _read_output(self, process: subprocess.Popen, pipe: io.BufferedReader, buffer: bytearray,
+                     exceeded: threading.Event | None):
+        """Reads the pipe until it is closed. Output over the limit stops the process group if `exceeded` is given
+        (stdout), otherwise only the end of the output is kept (stderr, whose last line is the error)."""
+        while chunk := pipe.read1(64 * 1024):
+            buffer += chunk
+            if len(buffer) <= self.max_output_size:
+                continue
+            if exceeded is not None:
+                exceeded.set()
+                self._kill_group(process)
+                return
+            del buffer[:-self.max_output_size]
+
+    @staticmethod
+    def _kill_group(process: subprocess.Popen):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            # The whole group already exited
+            pass
@@ -0,0 +1,226 @@
+import time
+import random
+import logging
+import threading
+import itertools
+from collections import deque
+from typing import Callable, Iterator, TypeVar
+
+import anthropic
+
+import config
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """Budget which refills at `rate_per_minute` up to the same capacity. Amounts larger than the capacity
+    are allowed once the bucket is full, leaving it in debt."""
+
+    def __init__(self, rate_per_minute: float, clock: Callable[[], float] = time.monotonic):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.tokens = rate_per_minute
+        self._clock = clock
+        self._updated_at = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def get_wait_time(self, amount: float) -> float:
+        self._refill()
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def consume(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+    def refund(self, amount: float):
+        """Returns an overestimated part of a consumed amount (takes more if `amount` is negative)."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class Scheduler:
+    """Lets calls to LLM through within requests per minute and tokens per minute budgets shared by the whole
+    process. Waiting calls are queued per client and clients take turns, so one long generation does not hold
+    up the others. Throttled calls (429 and 529 responses) pause all calls for `retry-after` seconds
+    or an exponential backoff with jitter, other transient failures (connection errors, 408, 409 and 5xx responses)
+    only wait for the backoff themselves. Both are retried up to `max_retries` times, and the tokens estimated for a
+    failed attempt are returned to the budget before the retry."""
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, requests_per_minute: float = config.LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: float = config.LLM_TOKENS_PER_MINUTE,
+                 max_retries: int = config.LLM_MAX_RETRIES, retry_base_delay: float = config.LLM_RETRY_BASE_DELAY,
+                 retry_max_delay: float = config.LLM_RETRY_MAX_DELAY, clock: Callable[[], float] = time.monotonic):
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self._clock = clock
+
+        # A limit of 0 disables the budget
+        self._request_bucket, self._token_bucket = None, None
+        if requests_per_minute:
+            self._request_bucket = TokenBucket(rate_per_minute=requests_per_minute, clock=clock)
+        if tokens_per_minute:
+            self._token_bucket = TokenBucket(rate_per_minute=tokens_per_minute, clock=clock)
+
+        self._condition = threading.Condition()
+        # Waiting calls of every client, clients are served in the order of `_clients`
+        self._queues = dict()
+        self._clients = deque()
+        self._paused_until = 0.0
+
+        self._wait_times = deque(maxlen=100)
+        self._throttled_number = 0
+
+    @classmethod
+    def get_shared(cls) -> "Scheduler":
+        """Scheduler shared by all chains of the process."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def get_stats(self) -> dict[str, float]:
+        with self._condition:
+            wait_times = list(self._wait_times)
+            return {
+                "queue_depth": sum(len(x) for x in self._queues.values()),
+                "client_number": len(self._clients),
+                "average_wait_time": sum(wait_times) / len(wait_times) if wait_times else 0.0,
+                "max_wait_time": max(wait_times, default=0.0),
+                "throttled_number": self._throttled_number,
+                "paused_for": max(0.0, self._paused_until - self._clock())
+            }
+
+    def _get_wait_time(self, tokens: int) -> float:
+        wait_time = self._paused_until - self._clock()
+        if self._request_bucket is not None:
+            wait_time = max(wait_time, self._request_bucket.get_wait_time(amount=1))
+        if self._token_bucket is not None:
+            wait_time = max(wait_time, self._token_bucket.get_wait_time(amount=tokens))
+        return wait_time
+
+    def acquire(self, client_id: str, tokens: int) -> float:
+        """Waits until it is the turn of the call and the budgets allow it, returns the time it waited."""
+        ticket = object()
+        with self._condition:
+            start = self._clock()
+            if client_id not in self._queues:
+                self._queues[client_id] = deque()
+                self._clients.append(client_id)
+            self._queues[client_id].append(ticket)
+
+            try:
+                while True:
+                    if self._clients[0] != client_id or self._queues[client_id][0] is not ticket:
+                        self._condition.wait()
+                        continue
+
+                    wait_time = self._get_wait_time(tokens=tokens)
+                    if wait_time <= 0:
+                        break
+                    self._condition.wait(timeout=wait_time)
+            finally:
+                # The client goes to the end of the line, so other clients get their turn before its next call
+                self._queues[client_id].remove(ticket)
+                self._clients.remove(client_id)
+                if self._queues[client_id]:
+                    self._clients.append(client_id)
+                else:
+                    del self._queues[client_id]
+                self._condition.notify_all()
+
+            if self._request_bucket is not None:
+                self._request_bucket.consume(amount=1)
+            if self._token_bucket is not None:
+                self._token_bucket.consume(amount=tokens)
+
+            wait_time = self._clock() - start
+            self._wait_times.append(wait_time)
+        return wait_time
+
+    def settle(self, estimated_tokens: int, used_tokens: int):
+        """Corrects the token budget once the actual usage of a call is known."""
+        if self._token_bucket is None:
+            return
+        with self._condition:
+            self._token_bucket.refund(amount=estimated_tokens - used_tokens)
+            self._condition.notify_all()
+
+    @staticmethod
+    def is_throttling_error(error: Exception) -> bool:
+        return isinstance(error, anthropic.APIStatusError) and error.status_code in (429, 529)
+
+    @classmethod
+    def is_retryable_error(cls, error: Exception) -> bool:
+        """Same errors as retried by the Anthropic client, except timeouts, after which callers do not wait
+        for the call anymore."""
+        if isinstance(error, anthropic.APITimeoutError):
+            return False
+        if isinstance(error, anthropic.APIConnectionError):
+            return True
+        return isinstance(error, anthropic.APIStatusError) and (
+            error.status_code in (408, 409) or error.status_code >= 500 or cls.is_throttling_error(error=error)
+        )
+
+    def _get_retry_delay(self, error: anthropic.APIError, attempt: int) -> float:
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            return min(float(retry_after), self.retry_max_delay)
+        except (TypeError, ValueError):
+            # Full jitter, so throttled callers do not come back all at the same time
+            return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+
+    def _prepare_retry(self, error: anthropic.APIError, attempt: int, tokens: int):
+        """Returns the tokens of the failed attempt and waits before the retry, throttling pauses all calls."""
+        self.settle(estimated_tokens=tokens, used_tokens=0)
+        delay = self._get_retry_delay(error=error, attempt=attempt)
+        if not self.is_throttling_error(error=error):
+            logger.warning("LLM call failed (attempt %d), retrying in %.1f s: %r", attempt + 1, delay, error)
+            time.sleep(delay)
+            return
+
+        logger.warning("LLM call was throttled (attempt %d), pausing for %.1f s: %r", attempt + 1, delay, error)
+        with self._condition:
+            self._throttled_number += 1
+            self._paused_until = max(self._paused_until, self._clock() + delay)
+            self._condition.notify_all()
+
+    def call(self, client_id: str, tokens: int, function: Callable[[], T]) -> T:
+        for attempt in itertools.count():
+            self.acquire(client_id=client_id, tokens=tokens)
+            try:
+                return function()
+            except anthropic.APIError as e:
+                if not self.is_retryable_error(error=e) or attempt >= self.max_retries:
+                    raise
+                self._prepare_retry(error=e, attempt=attempt, tokens=tokens)
+
+    def stream(self, client_id: str, tokens: int, function: Callable[[], Iterator[T]]) -> Iterator[T]:
+        """Same as `call` for a streamed response, which is retried only if it fails before the first item."""
+        for attempt in itertools.count():
+            self.acquire(client_id=client_id, tokens=tokens)
+            iterator = function()
+            try:
+                first = next(iterator)
+            except StopIteration:
+                return
+            except anthropic.APIError as e:
+                if not self.is_retryable_error(error=e) or attempt >= self.max_retries:
+                    raise
+                self._prepare_retry(error=e, attempt=attempt, tokens=tokens)
+                continue
+
+            yield first
+            yield from iterator
+            return
@@ -0,0 +1,143 @@
+import re
+import zlib
+import random
+
+import numpy as np
+
+import config
+
+
+class Similarity:
+    @staticmethod
+    def get_signatures(texts: list[str], dimension: int = config.CHUNK_SIGNATURE_DIMENSION,
+                       ngram_size: int = config.CHUNK_SIGNATURE_NGRAM_SIZE) -> np.ndarray:
+        """Hashed word n-gram vectors of texts, normalized to unit length (zero for texts without words).
+
+        Hashes do not depend on the process (unlike `hash()` of strings), so signatures of a text are always the same.
+        """
+        signatures = np.zeros((len(texts), dimension), dtype=np.float32)
+
+        for i, text in enumerate(texts):
+            words = re.findall(r"\w+", text.lower())
+            hashes = [zlib.crc32(x.encode()) for x in words]
+            for n in range(2, ngram_size + 1):
+                hashes.extend(zlib.crc32(" ".join(words[j:j + n]).encode()) for j in range(len(words) - n + 1))
+            if hashes:
+                signatures[i] = np.bincount(np.array(hashes, dtype=np.int64) % dimension, minlength=dimension)
+
+        # Sublinear term frequency, so repeated words do not dominate the signature
+        np.log1p(signatures, out=signatures)
+        norms = np.linalg.norm(signatures, axis=1, keepdims=True)
+        np.divide(signatures, norms, out=signatures, where=norms > 0)
+        return signatures
+
+    @staticmethod
+    def get_max_similarity(signatures: np.ndarray, selected_signatures: np.ndarray) -> np.ndarray:
+        """Cosine similarity of every signature to the closest of selected ones (1 for texts without words)."""
+        max_similarity = np.zeros(len(signatures), dtype=np.float32)
+        if len(selected_signatures):
+            max_similarity = (signatures @ selected_signatures.T).max(axis=1)
+
+        max_similarity[~signatures.any(axis=1)] = 1.0
+        return max_similarity
+
+    @classmethod
+    def order_by_diversity(cls, signatures: np.ndarray, selected_number: int,
+                           selected_signatures: np.ndarray | None = None,
+                           rng: random.Random | None = None) -> list[int]:
+        """Indexes of signatures, the first `selected_number` of which are picked to be as far apart as possible.
+
+        Selection is greedy: each next signature is the least similar one to those picked before (including
+        `selected_signatures`). The rest are ordered from the most novel to the least novel one.
+        """
+        if selected_signatures is None:
+            selected_signatures = signatures[:0]
+        max_similarity = cls.get_max_similarity(signatures=signatures, selected_signatures=selected_signatures)
+
+        order = []
+        for _ in range(min(selected_number, len(signatures))):
+            if not order and not len(selected_signatures):
+                i = (rng or random).randrange(len(signatures))
+            else:
+                i = int(np.argmin(max_similarity))
+            order.append(i)
+
+            np.maximum(max_similarity, signatures @ signatures[i], out=max_similarity)
+            max_similarity[i] = np.inf
+
+        rest = np.argsort(max_similarity, kind="stable")[:len(signatures) - len(order)]
+        return order + rest.tolist()
+
+
+class NoveltyFilter:
+    """Keeps signatures of accepted texts and rejects texts which are too similar to any of them."""
+
+    def __init__(self, max_similarity: float = config.CHUNK_DUPLICATE_SIMILARITY):
+        self.max_similarity = max_similarity
+        self.signatures = np.zeros((0, config.CHUNK_SIGNATURE_DIMENSION), dtype=np.float32)
+
+    def is_novel(self, signature: np.ndarray) -> bool:
+        similarity = Similarity.get_max_similarity(signatures=signature[None], selected_signatures=self.signatures)
+        return bool(similarity[0] < self.max_similarity)
+
+    def add(self, signature: np.ndarray):
+        self.signatures = np.vstack([self.signatures, signature[None]])
+
+
+class MinHashIndex:
+    """Keeps MinHash signatures of word shingles of accepted texts and rejects texts which are too similar
+    to any of them. A text is compared only to the ones which share at least one band of the signature with it
+    (locality-sensitive hashing), so the cost of a check does not grow with the number of accepted texts."""
+
+    MERSENNE_PRIME = (1 << 61) - 1
+
+    def __init__(self, max_similarity: float = config.QUESTION_DUPLICATE_SIMILARITY,
+                 shingle_size: int = config.QUESTION_SHINGLE_SIZE,
+                 permutation_number: int = config.MINHASH_PERMUTATION_NUMBER,
+                 band_number: int = config.MINHASH_BAND_NUMBER, seed: int = 0):
+        if permutation_number % band_number:
+            raise ValueError("Number of permutations must be a multiple of the number of bands")
+
+        self.max_similarity = max_similarity
+        self.shingle_size = shingle_size
+        self.band_number = band_number
+
+        # Permutations are `(a * x + b) mod p`, `a * x` wraps around 2^64 like in common MinHash implementations,
+        # smaller `a` would keep the order of small hashes the same in every permutation
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, self.MERSENNE_PRIME, size=permutation_number, dtype=np.uint64)
+        self._b = rng.integers(0, self.MERSENNE_PRIME, size=permutation_number, dtype=np.uint64)
+
+        self._signatures = []
+        self._buckets = [dict() for _ in range(band_number)]
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def get_signature(self, text: str) -> np.ndarray:
+        words = re.findall(r"\w+", text.lower())
+        shingles = {" ".join(words[i:i + self.shingle_size]) for i in range(max(len(words) - self.shingle_size, 0) + 1)}
+        hashes = np.fromiter((zlib.crc32(x.encode()) for x in shingles), dtype=np.uint64, count=len(shingles))
+        return ((hashes[:, None] * self._a + self._b) % np.uint64(self.MERSENNE_PRIME)).min(axis=0)
+
+    def _get_bands(self, signature: np.ndarray) -> list[bytes]:
+        return [band.tobytes() for band in np.split(signature, self.band_number)]
+
+    def get_max_similarity(self, signature: np.ndarray) -> float:
+        """Estimated Jaccard similarity of the text to the closest of accepted ones which share a band with it."""
+        candidates = set()
+        for band, bucket in zip(self._get_bands(signature=signature), self._buckets):
+            candidates.update(bucket.get(band, ()))
+        if not candidates:
+            return 0.0
+
+        candidate_signatures = np.stack([self._signatures[i] for i in candidates])
+        return float((candidate_signatures == signature).mean(axis=1).max())
+
+    def is_novel(self, signature: np.ndarray) -> bool:
+        return self.get_max_similarity(signature=signature) < self.max_similarity
+
+    def add(self, signature: np.ndarray):
+        for band, bucket in zip(self._get_bands(signature=signature), self._buckets):
+            bucket.setdefault(band, []).append(len(self._signatures))
+        self._signatures.append(signature)
@@ -0,0 +1,40 @@
+import types
+import unittest
+
+import config
+from chain import Chain
+from generator import Generator
+
+
+class TestRequestTasks(unittest.TestCase):
+    def setUp(self):
+        # Packing only estimates tokens of chunks, no LLM is called
+        self.generator = Generator(chain=types.SimpleNamespace(estimate_tokens=Chain.estimate_tokens))
+        self.max_question_number = config.LLM_MAX_OUTPUT_TOKENS // config.QUESTION_TOKEN_ESTIMATE
+
+    def get_requests(self, chunk_tasks: list[tuple[int, str, int]], max_question_number: int) -> list[list]:
+        return list(self.generator._iter_request_tasks(
+            chunk_tasks=chunk_tasks,
+            overhead_tokens=0,
+            max_question_number=max_question_number
+        ))
+
+    def test_large_chunk_quotas_are_split(self):
+        chunk_tasks = [(0, "a" * 100, 34), (1, "b" * 100, 33), (2, "c" * 100, 33)]
+        requests = self.get_requests(chunk_tasks=chunk_tasks, max_question_number=100)
+
+        for request in requests:
+            self.assertLessEqual(sum(x[2] for x in request), self.max_question_number)
+        for index, _, question_number in chunk_tasks:
+            split_number = sum(x[2] for request in requests for x in request if x[0] == index)
+            self.assertEqual(split_number, question_number)
+
+    def test_small_chunk_quotas_are_packed(self):
+        chunk_tasks = [(i, "x" * 100, 2) for i in range(6)]
+        requests = self.get_requests(chunk_tasks=chunk_tasks, max_question_number=4)
+
+        self.assertEqual([[x[0] for x in request] for request in requests], [[0, 1], [2, 3], [4, 5]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import random
+import unittest
+
+from reader import ProcessPDF, Reader, TextNormalizer
+
+
+def normalize_by_chain(text: str) -> str:
+    """Normalization of extracted PDF text as it was written before the rule tables."""
+    text = text.replace(" \n", " ").replace("\xa0", " ")
+    text = text.replace(".\n", ".\n\n").replace("?\n", "?\n\n").replace("!\n", "!\n\n")
+    text = text.replace("–", "-").replace(" -\n", "").replace("-\n", "-")
+    return text.replace("/\n", "/")
+
+
+class TestTextNormalization(unittest.TestCase):
+    # Characters of all rules and some which are not part of any
+    ALPHABET = " \xa0\n.?!–-/ab"
+
+    def test_rules_match_chain(self):
+        rnd = random.Random(0)
+        rules = ProcessPDF.get_normalization_rules()
+        for _ in range(20000):
+            text = "".join(rnd.choice(self.ALPHABET) for _ in range(rnd.randint(0, 30)))
+            self.assertEqual(TextNormalizer.apply_rules(rules=rules, text=text), normalize_by_chain(text), repr(text))
+
+    def test_fix_methods_match_chain(self):
+        text = "Word -\nbreak and/\nslash.\nNext?\nYes!\n\xa0a – b \nend-\nline"
+        fixed = ProcessPDF.fix_whitespaces(text=text)
+        fixed = ProcessPDF.fix_paragraphs(text=fixed)
+        fixed = ProcessPDF.fix_hyphen_usage(text=fixed)
+        fixed = ProcessPDF.fix_slash_usage(text=fixed)
+        self.assertEqual(fixed, normalize_by_chain(text))
+
+    def test_rules_are_ordered(self):
+        # " -\n" must be removed before "-\n" joins the line
+        rules = (("-\n", "-"), (" -\n", ""))
+        self.assertEqual(TextNormalizer.apply_rules(rules=rules, text="a -\nb"), "a -b")
+        self.assertEqual(TextNormalizer.apply_rules(rules=rules[::-1], text="a -\nb"), "ab")
+
+
+class TestTextChunks(unittest.TestCase):
+    WORDS = ["lorem", "ipsum", "dolor", "sit", "amet.", " ", " ", " ", "\n", "\n\n", "\n\n\n\n"]
+
+    def get_pages(self, rnd: random.Random) -> list[str]:
+        weights = [5, 5, 5, 5, 5, 10, 10, 10, 1, rnd.choice([0.01, 0.2, 1]), 0.05]
+        return ["".join(rnd.choices(self.WORDS, weights, k=rnd.randint(0, 2000))) for _ in range(rnd.randint(1, 30))]
+
+    def test_streamed_chunks_match_whole_text(self):
+        rnd = random.Random(0)
+        for _ in range(40):
+            pages = self.get_pages(rnd=rnd)
+            self.assertEqual(list(Reader.iter_text_chunks(pieces=pages)), Reader.get_text_chunks(text="".join(pages)))
+
+    def test_long_parts_match_whole_text(self):
+        # Paragraphs longer than a chunk are split by the next separators
+        pages = ["word " * 2000, "\n\n", "x" * 9000, "line\n" * 1500, "\n\nend"]
+        self.assertEqual(list(Reader.iter_text_chunks(pieces=pages)), Reader.get_text_chunks(text="".join(pages)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,196 @@
+import time
+import unittest
+import threading
+from unittest import mock
+
+import anthropic
+import httpx
+from langchain_core.language_models import FakeListChatModel
+
+import config
+from chain import Chain
+from scheduler import Scheduler, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+def get_request() -> httpx.Request:
+    return httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+
+
+def get_status_error(status_code: int, headers: dict[str, str] | None = None) -> anthropic.APIStatusError:
+    response = httpx.Response(status_code, headers=headers, request=get_request())
+    return anthropic.APIStatusError("error", response=response, body=None)
+
+
+def wait_until(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Condition was not met in time")
+        time.sleep(0.01)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = TokenBucket(rate_per_minute=60, clock=self.clock)
+
+    def test_refills_at_rate_up_to_capacity(self):
+        self.bucket.consume(amount=60)
+        self.assertEqual(self.bucket.get_wait_time(amount=30), 30)
+
+        self.clock.advance(10)
+        self.assertEqual(self.bucket.get_wait_time(amount=30), 20)
+
+        self.clock.advance(1000)
+        self.assertEqual(self.bucket.get_wait_time(amount=60), 0)
+        self.assertEqual(self.bucket.tokens, 60)
+
+    def test_large_amount_waits_for_full_bucket_and_leaves_debt(self):
+        self.bucket.consume(amount=30)
+        self.assertEqual(self.bucket.get_wait_time(amount=100), 30)
+
+        self.clock.advance(30)
+        self.assertEqual(self.bucket.get_wait_time(amount=100), 0)
+        self.bucket.consume(amount=100)
+        self.assertEqual(self.bucket.get_wait_time(amount=1), 41)
+
+    def test_refund_is_capped_at_capacity(self):
+        self.bucket.consume(amount=50)
+        self.bucket.refund(amount=30)
+        self.assertEqual(self.bucket.tokens, 40)
+        self.bucket.refund(amount=100)
+        self.assertEqual(self.bucket.tokens, 60)
+        # Negative refund takes the part which was underestimated
+        self.bucket.refund(amount=-20)
+        self.assertEqual(self.bucket.tokens, 40)
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def get_scheduler(self, requests_per_minute: float = 600, **kwargs) -> Scheduler:
+        return Scheduler(requests_per_minute=requests_per_minute, tokens_per_minute=6000, max_retries=3,
+                         retry_base_delay=0, retry_max_delay=30, clock=self.clock, **kwargs)
+
+    def test_clients_take_turns(self):
+        # One request per minute, so calls are let through one at a time as the clock advances
+        scheduler = self.get_scheduler(requests_per_minute=1)
+        scheduler.acquire(client_id="x", tokens=1)
+
+        order = []
+        threads = []
+        for client_id, name in (("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"), ("c", "c1")):
+            thread = threading.Thread(
+                target=lambda c=client_id, n=name: (scheduler.acquire(client_id=c, tokens=1), order.append(n)),
+                daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+            wait_until(lambda: scheduler.get_stats()["queue_depth"] == len(threads))
+
+        for i in range(len(threads)):
+            self.clock.advance(60)
+            # Wakes up the waiting calls
+            scheduler.settle(estimated_tokens=0, used_tokens=0)
+            wait_until(lambda: len(order) == i + 1)
+        for thread in threads:
+            thread.join(timeout=5)
+
+        self.assertEqual(order, ["a1", "b1", "c1", "a2", "a3"])
+
+    def test_throttling_pauses_for_retry_after(self):
+        scheduler = self.get_scheduler()
+        results = []
+        function = mock.Mock(side_effect=[get_status_error(429, headers={"retry-after": "12"}), "response"])
+        thread = threading.Thread(
+            target=lambda: results.append(scheduler.call(client_id="a", tokens=100, function=function)),
+            daemon=True
+        )
+        with self.assertLogs("scheduler", level="WARNING"):
+            thread.start()
+            wait_until(lambda: scheduler.get_stats()["throttled_number"] == 1)
+        self.assertEqual(scheduler.get_stats()["paused_for"], 12)
+        self.assertEqual(function.call_count, 1)
+
+        self.clock.advance(12)
+        scheduler.settle(estimated_tokens=0, used_tokens=0)
+        thread.join(timeout=5)
+        self.assertEqual(results, ["response"])
+        self.assertEqual(function.call_count, 2)
+
+    def test_retry_after_is_capped(self):
+        scheduler = self.get_scheduler()
+        function = mock.Mock(side_effect=[get_status_error(529, headers={"retry-after": "1000"}), "response"])
+        thread = threading.Thread(target=scheduler.call, args=("a", 100, function), daemon=True)
+        with self.assertLogs("scheduler", level="WARNING"):
+            thread.start()
+            wait_until(lambda: scheduler.get_stats()["throttled_number"] == 1)
+        self.assertEqual(scheduler.get_stats()["paused_for"], 30)
+
+        self.clock.advance(30)
+        scheduler.settle(estimated_tokens=0, used_tokens=0)
+        thread.join(timeout=5)
+        self.assertEqual(function.call_count, 2)
+
+    def test_failed_attempts_return_their_tokens(self):
+        scheduler = self.get_scheduler()
+        function = mock.Mock(side_effect=[get_status_error(500), anthropic.APIConnectionError(request=get_request()),
+                                          "response"])
+        with self.assertLogs("scheduler", level="WARNING"):
+            self.assertEqual(scheduler.call(client_id="a", tokens=100, function=function), "response")
+        self.assertEqual(function.call_count, 3)
+        # Only the successful attempt keeps its estimate
+        self.assertEqual(scheduler._token_bucket.tokens, 5900)
+
+    def test_other_errors_are_not_retried(self):
+        scheduler = self.get_scheduler()
+        for error in (get_status_error(400), anthropic.APITimeoutError(request=get_request())):
+            function = mock.Mock(side_effect=error)
+            with self.assertRaises(type(error)):
+                scheduler.call(client_id="a", tokens=100, function=function)
+            self.assertEqual(function.call_count, 1)
+
+    def test_retries_are_limited(self):
+        scheduler = self.get_scheduler()
+        function = mock.Mock(side_effect=get_status_error(503))
+        with self.assertLogs("scheduler", level="WARNING"), self.assertRaises(anthropic.APIStatusError):
+            scheduler.call(client_id="a", tokens=100, function=function)
+        self.assertEqual(function.call_count, 4)
+
+    def test_retryable_errors(self):
+        for status_code in (408, 409, 429, 500, 529):
+            self.assertTrue(Scheduler.is_retryable_error(error=get_status_error(status_code)), status_code)
+        for status_code in (400, 401, 404, 413):
+            self.assertFalse(Scheduler.is_retryable_error(error=get_status_error(status_code)), status_code)
+        self.assertTrue(Scheduler.is_retryable_error(error=anthropic.APIConnectionError(request=get_request())))
+        self.assertFalse(Scheduler.is_retryable_error(error=anthropic.APITimeoutError(request=get_request())))
+
+
+@mock.patch.object(config, "LLM_CACHE_ENABLED", False)
+class TestChainScheduler(unittest.TestCase):
+    def get_llm(self) -> FakeListChatModel:
+        return FakeListChatModel(responses=["response"])
+
+    @mock.patch.object(config, "LLM_SCHEDULER_ENABLED", True)
+    def test_shared_scheduler_by_default(self):
+        self.assertIs(Chain(llm=self.get_llm()).scheduler, Scheduler.get_shared())
+
+    @mock.patch.object(config, "LLM_SCHEDULER_ENABLED", True)
+    def test_none_disables_scheduling(self):
+        self.assertIsNone(Chain(llm=self.get_llm(), scheduler=None).scheduler)
+
+
+if __name__ == "__main__":
+    unittest.main()
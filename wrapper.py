@@ -1,107 +1,287 @@
+import re
 import random
+import threading
 from abc import ABC, abstractmethod
-from typing import Any
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, Sequence
 from xml.etree import ElementTree
 
 import config
 
 
 class BaseQuestion(ABC):
+    """Question compiled into a compact record, which is shared (read only) by all sessions showing the quiz.
+    Answers are normalized once, when the record is built."""
+
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    @classmethod
+    @abstractmethod
+    def from_row(cls, row: dict[str, Any]) -> "BaseQuestion":
+        """Question of a row of `Wrapper.get_question_row`."""
+        pass
+
     @abstractmethod
     def get_data(self) -> dict[str, Any]:
         pass
 
+    def has_valid_answers(self) -> bool:
+        """Whether the answers fit the type of the question (fields are already known to be present)."""
+        return True
+
+    @classmethod
+    def is_valid(cls, element: ElementTree.Element) -> bool:
+        """Whether the element has every field the question reads, none of them empty, and valid answers."""
+        try:
+            question = cls.from_row(row=Wrapper.get_question_row(element=element))
+        except (AttributeError, IndexError, TypeError):
+            # Type or text of the element, its answers or options are missing
+            return False
+
+        data = question.get_data()
+        for value in data.values():
+            values = value if isinstance(value, list) else [value]
+            if not values or not all(values):
+                return False
+        if "options" in data and len(data["options"]) < 2:
+            return False
+        return question.has_valid_answers()
+
 
 class TrueFalseQuestion(BaseQuestion):
-    def __init__(self, element: ElementTree.Element):
-        self._data = {
-            "text": element.find("text").text,
-            "answer": element.find("answers").find("answer").text
-        }
+    __slots__ = ("answer", "_answer_key")
+
+    def __init__(self, text: str, answer: str):
+        super().__init__(text=text)
+        self.answer = answer
+        self._answer_key = (answer or "").lower()
+
+    @classmethod
+    def from_row(cls, row: dict[str, Any]) -> "TrueFalseQuestion":
+        return cls(text=row["text"], answer=row["answers"][0])
 
     def get_data(self) -> dict[str, Any]:
-        return self._data
+        return {"text": self.text, "answer": self.answer}
+
+    def is_correct(self, choice: str) -> bool:
+        return choice.lower() == self._answer_key
+
+    def has_valid_answers(self) -> bool:
+        return self._answer_key in ("true", "false")
 
 
 class SingleCorrectQuestion(BaseQuestion):
-    def __init__(self, element: ElementTree.Element):
-        self._data = {
-            "text": element.find("text").text,
-            "options": [x.text for x in element.find("options").findall("option")],
-            "answer": element.find("answers").find("answer").text
-        }
+    __slots__ = ("options", "answer")
+
+    def __init__(self, text: str, options: tuple[str, ...], answer: str):
+        super().__init__(text=text)
+        self.options = options
+        self.answer = answer
+
+    @classmethod
+    def from_row(cls, row: dict[str, Any]) -> "SingleCorrectQuestion":
+        return cls(text=row["text"], options=tuple(row["options"]), answer=row["answers"][0])
 
     def get_data(self) -> dict[str, Any]:
-        return self._data
+        return {"text": self.text, "options": list(self.options), "answer": self.answer}
+
+    def is_correct(self, choice: str) -> bool:
+        return choice == self.answer
+
+    def has_valid_answers(self) -> bool:
+        return self.answer in self.options
 
 
 class MultipleCorrectQuestion(BaseQuestion):
-    def __init__(self, element: ElementTree.Element):
-        self._data = {
-            "text": element.find("text").text,
-            "options": [x.text for x in element.find("options").findall("option")],
-            "answers": [x.text for x in element.find("answers").findall("answer")]
-        }
+    __slots__ = ("options", "answers", "_answer_set")
+
+    def __init__(self, text: str, options: tuple[str, ...], answers: tuple[str, ...]):
+        super().__init__(text=text)
+        self.options = options
+        self.answers = answers
+        self._answer_set = frozenset(answers)
+
+    @classmethod
+    def from_row(cls, row: dict[str, Any]) -> "MultipleCorrectQuestion":
+        return cls(text=row["text"], options=tuple(row["options"]), answers=tuple(row["answers"]))
 
     def get_data(self) -> dict[str, Any]:
-        return self._data
+        return {"text": self.text, "options": list(self.options), "answers": list(self.answers)}
+
+    def is_correct(self, option: str) -> bool:
+        """Whether the option is one of the answers."""
+        return option in self._answer_set
+
+    def has_valid_answers(self) -> bool:
+        return self._answer_set <= set(self.options)
 
 
 class NoChoiceQuestion(BaseQuestion):
-    def __init__(self, element: ElementTree.Element):
-        self._data = {
-            "text": element.find("text").text,
-            "answer": element.find("answers").find("answer").text
-        }
+    __slots__ = ("answer", "_answer_key")
+
+    def __init__(self, text: str, answer: str):
+        super().__init__(text=text)
+        self.answer = answer
+        self._answer_key = (answer or "").lower()
+
+    @classmethod
+    def from_row(cls, row: dict[str, Any]) -> "NoChoiceQuestion":
+        return cls(text=row["text"], answer=row["answers"][0])
 
     def get_data(self) -> dict[str, Any]:
-        return self._data
+        return {"text": self.text, "answer": self.answer}
+
+    def is_correct(self, choice: str) -> bool:
+        return choice.lower() == self._answer_key
 
 
 class MathProblemQuestion(BaseQuestion):
-    def __init__(self, element: ElementTree.Element):
-        self._data = {
-            "text": element.find("text").text,
-            "answer": element.find("answers").find("answer").text
-        }
+    __slots__ = ("answer", "_answer_value")
+
+    def __init__(self, text: str, answer: str):
+        super().__init__(text=text)
+        self.answer = answer
+        self._answer_value = self.get_number(text=answer or "")
+
+    @classmethod
+    def from_row(cls, row: dict[str, Any]) -> "MathProblemQuestion":
+        return cls(text=row["text"], answer=row["answers"][0])
 
     def get_data(self) -> dict[str, Any]:
-        return self._data
+        return {"text": self.text, "answer": self.answer}
+
+    @staticmethod
+    def get_number(text: str) -> float | None:
+        """First number in the text, `None` if there is none."""
+        match = re.search(pattern=Wrapper.get_float_regexp(), string=text)
+        return float(match.group()) if match else None
+
+    def is_correct(self, choice: str) -> bool:
+        value = self.get_number(text=choice)
+        if value is None or self._answer_value is None:
+            return False
+        # Same tolerance as `numpy.isclose(value, answer, rtol=1e-4, atol=1e-4)`
+        return abs(value - self._answer_value) <= 1e-4 + 1e-4 * abs(self._answer_value)
+
+    @classmethod
+    def is_valid(cls, element: ElementTree.Element) -> bool:
+        # Answers are added by the math solver after generation
+        text = element.find("text")
+        return text is not None and bool(text.text and text.text.strip())
+
+
+@dataclass
+class ParseStats:
+    # Elements which were parsed only after escaping stray `&` and `<` in them
+    repaired: int = 0
+    # Elements which could not be parsed
+    dropped: int = 0
+    # Unfinished element at the end of the data
+    truncated: int = 0
+
+    def add(self, other: "ParseStats"):
+        self.repaired += other.repaired
+        self.dropped += other.dropped
+        self.truncated += other.truncated
 
 
 class Wrapper:
+    QUESTION_CLASSES = {
+        "true/false": TrueFalseQuestion,
+        "single correct": SingleCorrectQuestion,
+        "multiple correct": MultipleCorrectQuestion,
+        "no choice": NoChoiceQuestion,
+        "math problem": MathProblemQuestion
+    }
+
     def __init__(self, xml_str: str, seed: int):
-        self._tree = self.str_to_xml(data=xml_str)
+        self._question_list = self.parse_questions(xml_str=xml_str)
+        self._index_list = self.get_permutation(length=len(self._question_list), seed=seed)
+
+    @classmethod
+    def from_questions(cls, questions: Sequence[BaseQuestion], seed: int) -> "Wrapper":
+        """Quiz of already parsed (or lazily loaded) questions, which may be shared with other instances."""
+        wrapper = cls.__new__(cls)
+        wrapper._question_list = questions
+        wrapper._index_list = cls.get_permutation(length=len(questions), seed=seed)
+        return wrapper
+
+    @staticmethod
+    def get_permutation(length: int, seed: int) -> list[int]:
+        """Order in which the questions are shown, the same for the same seed."""
+        index_list = list(range(length))
+        random.Random(seed).shuffle(index_list)
+        return index_list
 
-        self._question_list = self._tree.findall("question")
-        self._index_list = list(range(self.__len__()))
-        random.seed(seed)
-        random.shuffle(self._index_list)
+    @classmethod
+    def parse_questions(cls, xml_str: str) -> tuple[BaseQuestion, ...]:
+        """Questions of the quiz compiled into records, the parsed XML is not kept."""
+        return tuple(cls.get_question(row=x) for x in cls.get_question_rows(xml_str=xml_str))
 
     def __len__(self) -> int:
         return len(self._question_list)
 
     def __getitem__(self, item: int) -> BaseQuestion:
-        element = self._question_list[self._index_list[item]]
-        question_type = element.find("type").text
+        return self._question_list[self._index_list[item]]
+
+    @classmethod
+    def get_question(cls, row: dict[str, Any]) -> BaseQuestion:
+        question_type = row["type"]
 
         if question_type in config.ALLOWED_QUESTION_TYPES:
-            if question_type.lower() == "true/false":
-                return TrueFalseQuestion(element=element)
-            elif question_type.lower() == "single correct":
-                return SingleCorrectQuestion(element=element)
-            elif question_type.lower() == "multiple correct":
-                return MultipleCorrectQuestion(element=element)
-            elif question_type.lower() == "no choice":
-                return NoChoiceQuestion(element=element)
-            elif question_type.lower() == "math problem":
-                return MathProblemQuestion(element=element)
-            else:
+            question_class = cls.QUESTION_CLASSES.get(question_type.lower())
+            if question_class is None:
                 raise NotImplementedError(f"Question Type '{question_type}' has no implementation!")
+            return question_class.from_row(row=row)
         else:
             raise TypeError(f"Question Type '{question_type}' is not allowed. "
                             f"Should be one of {config.ALLOWED_QUESTION_TYPES}!")
 
+    @staticmethod
+    def get_question_row(element: ElementTree.Element) -> dict[str, Any]:
+        """Fields of a question as they are stored in the database, `options` is `None` for types without them.
+        Whitespace around values is removed."""
+        def strip(text: str | None) -> str | None:
+            return None if text is None else text.strip()
+
+        options = element.find("options")
+        answers = element.find("answers")
+        return {
+            "type": strip(element.find("type").text),
+            "text": strip(element.find("text").text),
+            "options": None if options is None else [strip(x.text) for x in options.findall("option")],
+            "answers": [] if answers is None else [strip(x.text) for x in answers.findall("answer")]
+        }
+
+    @staticmethod
+    def get_question_element(row: dict[str, Any]) -> ElementTree.Element:
+        element = ElementTree.Element("question")
+        ElementTree.SubElement(element, "type").text = row["type"]
+        ElementTree.SubElement(element, "text").text = row["text"]
+        if row["options"] is not None:
+            options = ElementTree.SubElement(element, "options")
+            for option in row["options"]:
+                ElementTree.SubElement(options, "option").text = option
+        answers = ElementTree.SubElement(element, "answers")
+        for answer in row["answers"]:
+            ElementTree.SubElement(answers, "answer").text = answer
+        return element
+
+    @classmethod
+    def get_question_rows(cls, xml_str: str) -> list[dict[str, Any]]:
+        return [cls.get_question_row(element=x) for x in cls.str_to_xml(data=xml_str).findall("question")]
+
+    @classmethod
+    def rows_to_xml(cls, rows: Iterable[dict[str, Any]]) -> str:
+        """Quiz in the XML format used for export."""
+        tree = cls.get_tree()
+        tree.getroot().extend(cls.get_question_element(row=x) for x in rows)
+        return cls.xml_to_str(data=tree)
+
     @classmethod
     def get_tree(cls) -> ElementTree.ElementTree:
         return cls.str_to_xml(data="<questions></questions>")
@@ -110,6 +290,60 @@ class Wrapper:
     def str_to_xml(data: str) -> ElementTree.ElementTree:
         return ElementTree.ElementTree(ElementTree.fromstring(data))
 
+    @staticmethod
+    def parse_element(data: str, stats: ParseStats) -> ElementTree.Element | None:
+        """Parses a single element, escaping `&` and `<` which do not start an entity or a tag if needed."""
+        try:
+            return ElementTree.fromstring(data)
+        except ElementTree.ParseError:
+            pass
+
+        data = re.sub(r"&(?!(?:amp|lt|gt|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);)", "&amp;", data)
+        data = re.sub(r"<(?![A-Za-z_/!?])", "&lt;", data)
+        try:
+            element = ElementTree.fromstring(data)
+        except ElementTree.ParseError:
+            stats.dropped += 1
+            return None
+        stats.repaired += 1
+        return element
+
+    @classmethod
+    def iter_elements(cls, pieces: Iterable[str], tag: str,
+                      stats: ParseStats | None = None) -> Iterator[ElementTree.Element]:
+        """Yields elements with `tag` from XML which arrives piece by piece, as soon as each of them is closed.
+
+        Elements are parsed one by one, so text around them, a malformed element or an unfinished last one
+        do not affect the others. All pieces are consumed, even after the last element.
+        """
+        stats = stats or ParseStats()
+        start_pattern = re.compile(rf"<{tag}[\s>]")
+        end_tag = f"</{tag}>"
+        buffer = ""
+
+        for piece in pieces:
+            buffer += piece
+            while True:
+                start = start_pattern.search(buffer)
+                if start is None:
+                    # The end of the buffer may be the beginning of the next start tag
+                    buffer = buffer[-len(tag) - 1:]
+                    break
+
+                end = buffer.find(end_tag, start.end())
+                if end == -1:
+                    buffer = buffer[start.start():]
+                    break
+
+                data = buffer[start.start():end + len(end_tag)]
+                buffer = buffer[end + len(end_tag):]
+                element = cls.parse_element(data=data, stats=stats)
+                if element is not None:
+                    yield element
+
+        if start_pattern.search(buffer):
+            stats.truncated += 1
+
     @staticmethod
     def xml_to_str(data: ElementTree.ElementTree) -> str:
         return ElementTree.tostring(data.getroot(), encoding="unicode", method="xml")
@@ -117,3 +351,72 @@ class Wrapper:
     @staticmethod
     def get_float_regexp() -> str:
         return r"[+-]?([0-9]*[.])?[0-9]+"
+
+
+class StoredQuiz:
+    """Questions of a stored quiz, loaded one at a time by position with `load_question(position)` (which returns
+    a question row) when they are first accessed. Questions are shared by all sessions which show the quiz,
+    so they are only read."""
+
+    def __init__(self, name: str, question_number: int, load_question: Callable[[int], dict[str, Any]]):
+        self.name = name
+        self._load_question = load_question
+        self._questions = [None] * question_number
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._questions)
+
+    def __getitem__(self, position: int) -> BaseQuestion:
+        question = self._questions[position]
+        if question is None:
+            question = Wrapper.get_question(row=self._load_question(position))
+            with self._lock:
+                self._questions[position] = question
+        return question
+
+
+class QuizCache:
+    """Stored quizzes by their keys, shared by all sessions of the process. Quizzes do not change once they
+    are stored, so the `max_size` most recently used ones are kept without expiration."""
+
+    def __init__(self, max_size: int = config.QUIZ_CACHE_MAX_SIZE):
+        self.max_size = max_size
+
+        self._quizzes = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def __len__(self) -> int:
+        return len(self._quizzes)
+
+    def get(self, key: str, load: Callable[[], StoredQuiz | None]) -> StoredQuiz | None:
+        """Cached quiz or the one returned by `load()`. Missing quizzes are not cached, as they may still
+        be generated."""
+        with self._lock:
+            quiz = self._quizzes.get(key)
+            if quiz is not None:
+                self._quizzes.move_to_end(key)
+                self._counters["hits"] += 1
+                return quiz
+            self._counters["misses"] += 1
+
+        # Loading does not hold the lock, so concurrent first loads of the same quiz may both query it
+        quiz = load()
+        if quiz is None:
+            return None
+
+        with self._lock:
+            self._quizzes[key] = quiz
+            self._quizzes.move_to_end(key)
+            while len(self._quizzes) > self.max_size:
+                self._quizzes.popitem(last=False)
+                self._counters["evictions"] += 1
+        return quiz
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+        requests = counters["hits"] + counters["misses"]
+        counters["hit_rate"] = counters["hits"] / requests if requests else 0.0
+        return counters